@@ -0,0 +1,243 @@
+import contextlib
+import io
+import os
+import socket
+import threading
+
+import pytest
+
+import tse_benchmark
+import tse_download_repositorio as tse
+
+
+class CountingHandler(tse_benchmark.Handler):
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        super().do_GET()
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', self.path))
+        super().do_HEAD()
+
+
+@pytest.fixture
+def fixtures(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('fixtures'))
+    tse_benchmark.Fixtures.build(folder, linhas=100, estados=['AC'])
+    return folder
+
+
+@pytest.fixture
+def redirected(tmp_path, monkeypatch):
+    ## redirect sets class attributes, which monkeypatch restores
+    monkeypatch.setattr(tse.TSE_download, 'url', tse.TSE_download.url)
+    monkeypatch.setattr(tse.TSE_download, 'folder_save', tse.TSE_download.folder_save)
+    monkeypatch.setattr(tse.TSE_write_parquet, 'folder', tse.TSE_write_parquet.folder)
+    for main_name, _, _ in tse_benchmark.Fixtures.casos:
+        main = getattr(tse, main_name)
+        monkeypatch.setattr(main, 'folder', main.folder)
+    monkeypatch.setattr(tse.TSE_download_manager, 'backoff', 0.01)
+    return lambda url: tse_benchmark.redirect(url, str(tmp_path))
+
+
+def test_incremental_revalidates_local_copy(fixtures, redirected, monkeypatch):
+    monkeypatch.setattr(CountingHandler, 'requests', [])
+    with tse_benchmark.Server(fixtures, CountingHandler) as server:
+        redirected(server.url)
+        for _ in range(2):
+            with contextlib.redirect_stdout(io.StringIO()):
+                tse.Main_votacao_secao.main_loop(anos=[2018], estados=['AC'], incremental=True)
+    path = '/votacao_secao/votacao_secao_2018_AC.zip'
+    assert CountingHandler.requests == [('GET', path), ('HEAD', path)]
+
+
+class LoggingFlakyHandler(tse_benchmark.FlakyHandler):
+
+    log = []
+
+    def do_GET(self):
+        self.log.append((self.path, self.headers.get('Range')))
+        super().do_GET()
+
+
+class DeadHandler(tse_benchmark.Handler):
+
+    log = []
+
+    def do_GET(self):
+        self.log.append(self.path)
+        self.send_error(503)
+
+
+def test_flaky_server(fixtures, redirected, monkeypatch):
+    monkeypatch.setattr(LoggingFlakyHandler, 'requests', {})
+    monkeypatch.setattr(LoggingFlakyHandler, 'log', [])
+    path = 'votacao_secao/votacao_secao_2018_AC.zip'
+    with tse_benchmark.Server(fixtures, LoggingFlakyHandler) as server:
+        redirected(server.url)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tse.TSE_download.download(path, stream=True)
+            with pytest.raises(IOError):
+                tse.TSE_download.download('votacao_secao/missing.zip', stream=True)
+    with open(os.path.join(fixtures, path), 'rb') as flread:
+        body = flread.read()
+    zipped = os.path.join(tse.TSE_download.folder_save, 'zipped')
+    with open(os.path.join(zipped, path), 'rb') as flread:
+        assert flread.read() == body
+    ## A 503, a body cut halfway and the rest of it
+    assert LoggingFlakyHandler.log[:3] == [
+        ('/' + path, None),
+        ('/' + path, None),
+        ('/' + path, 'bytes={}-'.format(len(body) // 2)),
+    ]
+    assert sorted(os.listdir(os.path.join(zipped, 'votacao_secao'))) == ['votacao_secao_2018_AC.zip']
+
+
+def test_retries_are_bounded(fixtures, redirected, monkeypatch):
+    monkeypatch.setattr(DeadHandler, 'log', [])
+    with tse_benchmark.Server(fixtures, DeadHandler) as server:
+        redirected(server.url)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with pytest.raises(tse.requests.HTTPError):
+                tse.TSE_download.download('votacao_secao/votacao_secao_2018_AC.zip', stream=True)
+    assert len(DeadHandler.log) == tse.TSE_download_manager.retries + 1
+
+
+def test_retries_are_bounded_on_dropped_connections(redirected):
+    ## A host that closes every connection without answering
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(50)
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            accepted.append(1)
+            connection.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    redirected('http://127.0.0.1:{}/'.format(listener.getsockname()[1]))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with pytest.raises(tse.requests.ConnectionError):
+                tse.TSE_download.download('votacao_secao/votacao_secao_2018_AC.zip', stream=True)
+    finally:
+        listener.close()
+    assert len(accepted) == tse.TSE_download_manager.retries + 1
+
+
+class RecordingHandler(tse_benchmark.Handler):
+
+    log = []
+
+    def send_response(self, code, *args):
+        self.log.append((self.command, self.headers.get('Range'), self.headers.get('If-Range'), code))
+        super().send_response(code, *args)
+
+
+@pytest.fixture
+def manager(fixtures, tmp_path, monkeypatch):
+    """
+    The path, body, URL and local names of one archive served by a local
+    Range-capable server, recording each request.
+    """
+    monkeypatch.setattr(RecordingHandler, 'log', [])
+    monkeypatch.setattr(tse.TSE_download_manager, 'backoff', 0.01)
+    path = 'votacao_secao/votacao_secao_2018_AC.zip'
+    with open(os.path.join(fixtures, path), 'rb') as flread:
+        body = flread.read()
+    with tse_benchmark.Server(fixtures, RecordingHandler) as server:
+        yield dict(
+            path=os.path.join(fixtures, path),
+            body=body,
+            url=server.url + path,
+            save_name=str(tmp_path / 'zipped' / 'votacao_secao_2018_AC.zip'),
+            manifest_name=str(tmp_path / 'manifest' / 'votacao_secao_2018_AC.zip.json'),
+        )
+
+
+def partial(manager, content, etag):
+    os.makedirs(os.path.dirname(manager['save_name']), exist_ok=True)
+    with open(manager['save_name'] + '.part', 'wb') as flsave:
+        flsave.write(content)
+    tse.TSE_download_manager.write_manifest(
+        manager['manifest_name'],
+        dict(url=manager['url'], status='partial', etag=etag, content_length=len(manager['body'])),
+    )
+
+
+def fetched(manager):
+    tse.TSE_download_manager.fetch(manager['url'], manager['save_name'], manager['manifest_name'])
+    with open(manager['save_name'], 'rb') as flread:
+        assert flread.read() == manager['body']
+    assert not os.path.exists(manager['save_name'] + '.part')
+    manifest = tse.TSE_download_manager.read_manifest(manager['manifest_name'])
+    assert manifest['status'] == 'complete'
+    assert manifest['size'] == len(manager['body'])
+    return manifest
+
+
+def test_fetch_resumes_partial_file(manager):
+    etag = tse_benchmark.Handler.etag(manager['path'])
+    half = len(manager['body']) // 2
+    partial(manager, manager['body'][:half], etag)
+    fetched(manager)
+    assert RecordingHandler.log == [('GET', 'bytes={}-'.format(half), etag, 206)]
+
+
+def test_fetch_restarts_when_etag_changed(manager):
+    half = len(manager['body']) // 2
+    partial(manager, b'x' * half, '"old"')
+    manifest = fetched(manager)
+    assert RecordingHandler.log == [('GET', 'bytes={}-'.format(half), '"old"', 200)]
+    assert manifest['etag'] == tse_benchmark.Handler.etag(manager['path'])
+
+
+def test_fetch_restarts_after_416(manager):
+    etag = tse_benchmark.Handler.etag(manager['path'])
+    partial(manager, manager['body'] + b'extra', etag)
+    fetched(manager)
+    size = len(manager['body']) + len(b'extra')
+    assert RecordingHandler.log == [
+        ('GET', 'bytes={}-'.format(size), etag, 416),
+        ('GET', None, None, 200),
+    ]
+
+
+def test_check_converts_files_saved_before_manifest(manager):
+    os.makedirs(os.path.dirname(manager['save_name']))
+    with open(manager['save_name'], 'wb') as flsave:
+        flsave.write(manager['body'])
+    assert tse.TSE_download_manager.check(manager['url'], manager['save_name'], manager['manifest_name'])
+    manifest = tse.TSE_download_manager.read_manifest(manager['manifest_name'])
+    assert manifest['status'] == 'complete'
+    assert manifest['size'] == len(manager['body'])
+    assert RecordingHandler.log == []
+
+
+def test_check_keeps_half_written_file_as_partial(manager):
+    os.makedirs(os.path.dirname(manager['save_name']))
+    with open(manager['save_name'], 'wb') as flsave:
+        flsave.write(manager['body'][:100])
+    assert not tse.TSE_download_manager.check(manager['url'], manager['save_name'], manager['manifest_name'])
+    assert not os.path.exists(manager['save_name'])
+    assert os.path.getsize(manager['save_name'] + '.part') == 100
+
+
+def test_check_revalidates(manager):
+    fetched(manager)
+    kwargs = dict(revalidate=True)
+    assert tse.TSE_download_manager.check(manager['url'], manager['save_name'], manager['manifest_name'], **kwargs)
+    ## The remote file changes
+    with open(manager['path'], 'ab') as flsave:
+        flsave.write(b'\0')
+    assert not tse.TSE_download_manager.check(manager['url'], manager['save_name'], manager['manifest_name'], **kwargs)
+    assert not os.path.exists(manager['save_name'])
+    assert [x[0] for x in RecordingHandler.log] == ['GET', 'HEAD', 'HEAD']
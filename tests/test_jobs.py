@@ -0,0 +1,44 @@
+import os
+import threading
+import time
+
+import tse_download_repositorio as tse
+
+
+def test_lease_taken_over_is_left_to_new_owner(tmp_path, monkeypatch):
+    monkeypatch.setattr(tse.TSE_lease, 'folder', str(tmp_path))
+    slow = tse.TSE_lease('parse|Main_votacao_secao|VotoSecao_2018_AC.csv')
+    assert slow.claim()
+    ## The slow node stops touching its lock, which expires
+    slow.stop.set()
+    old = time.time() - 2 * slow.ttl
+    os.utime(slow.lock_name, (old, old))
+
+    new = tse.TSE_lease(slow.key)
+    assert new.claim()
+    assert new.owns() and not slow.owns()
+    mtime = os.path.getmtime(new.lock_name)
+
+    ## The heartbeat of the slow node gives up instead of renewing it
+    slow.stop, slow.ttl = threading.Event(), 0.03
+    heartbeat = threading.Thread(target=slow.heartbeat, daemon=True)
+    heartbeat.start()
+    heartbeat.join(5)
+    assert not heartbeat.is_alive()
+    assert os.path.getmtime(new.lock_name) == mtime
+
+    slow.release(done=True)
+    assert new.owns()
+    assert not slow.is_done()
+
+    new.release(done=True)
+    assert not os.path.exists(new.lock_name)
+    assert new.is_done()
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(new.done_name)]
+
+
+def test_temp_names_are_unique_to_the_process(tmp_path):
+    save_full = str(tmp_path / 'VotoSecao_2018_AC.csv')
+    writer = tse.TSE_write_csv(save_full)
+    assert writer.temp_name != save_full + '.tmp'
+    assert str(os.getpid()) in os.path.basename(writer.temp_name)
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+import tse_benchmark
+import tse_download_repositorio as tse
+
+
+def layout_cases():
+    for main_name, _, _ in tse_benchmark.Fixtures.casos:
+        main = getattr(tse, main_name)
+        parser = main.class_parser
+        for layout in tse.TSE_schemas.layouts(parser.dataset, main.parser_kwargs.get('nivel')):
+            yield pytest.param(main, layout, id='{}:{}'.format(parser.dataset, layout['nome']))
+
+
+@pytest.mark.parametrize('to_numeric', [False, True])
+@pytest.mark.parametrize('engine', [None, 'pyarrow'])
+@pytest.mark.parametrize('main, layout', list(layout_cases()))
+def test_parse_engine(main, layout, engine, to_numeric):
+    if engine == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    parser = main.class_parser
+    ano = tse_benchmark.Fixtures.ano(layout)
+    content = tse_benchmark.Fixtures.member(layout, parser, ano, ['AC', 'SP'], 50, random.Random(0))
+    kwargs = dict(main.parser_kwargs, to_numeric=to_numeric)
+    df = parser.parse(content, ano=ano, engine=engine, **kwargs)
+    expected = parser.parse(content, ano=ano, **kwargs)
+    assert len(df) == 50
+    tse.pandas.testing.assert_frame_equal(df, expected)
+
+
+def test_parse_pyarrow_keeps_leading_zeros():
+    pytest.importorskip('pyarrow')
+    parser = tse.TSE_parse_candidatos
+    layout = next(x for x in tse.TSE_schemas.layouts(parser.dataset) if x['header'] == 0)
+    content = tse_benchmark.Fixtures.member(layout, parser, tse_benchmark.Fixtures.ano(layout), ['AC'], 5, random.Random(0))
+    names = dict((x[0], x[1]) for x in layout['columns'])
+    lines = content.decode('latin1').splitlines()
+    header = [x.strip('"') for x in lines[0].split(';')]
+    row = lines[1].split(';')
+    for source in ['SG_UE', 'NR_CPF_CANDIDATO']:
+        if source in names:
+            row[header.index(source)] = '"01120"'
+    content = '\n'.join([lines[0], ';'.join(row)] + lines[2:]).encode('latin1')
+    df = parser.parse(content, ano=tse_benchmark.Fixtures.ano(layout), engine='pyarrow', to_numeric=True)
+    for source in ['SG_UE', 'NR_CPF_CANDIDATO']:
+        if source in names:
+            assert df[names[source]].iloc[0] == '01120'
+
+
+@pytest.mark.parametrize('nullable', [False, True])
+def test_to_numeric_keeps_values_out_of_range(nullable):
+    df = tse.pandas.DataFrame({
+        'Turno': ['1', '404', None],
+        'Urna_número': ['80443028401', '12', 'x'],
+        'Partido_número': ['13', '45', '#NULO#'],
+    })
+    dtypes = {'Turno': 'int8', 'Urna_número': 'int32', 'Partido_número': 'int16'}
+    df = tse.TSE_parse.to_numeric(df, dtypes, nullable=nullable)
+    assert df['Turno'].tolist()[:2] == [1, 404]
+    assert df['Urna_número'].tolist()[:2] == [80443028401, 12]
+    assert str(df['Partido_número'].dtype).lower() == 'int16'
+    for col in dtypes:
+        if nullable:
+            assert tse.pandas.isna(df[col].iloc[2])
+        else:
+            assert df[col].iloc[2] == -1
+
+
+@pytest.mark.parametrize('values', [
+    ['BRANCA', 'Parda', ' preta ', 'BRANCA', 'INDÍGENA', 'amarela'],
+    ['BRANCA', None, 'VERDE', float('nan'), '#NULO#', 'PARDA'],
+    [1, 'BRANCA', 2.5, None, 'parda'],
+    [None, None],
+    [],
+])
+def test_map_depara_same_as_apply(values):
+    depara = tse.TSE_parse_candidatos.tabelas_depara['Cor']
+    series = tse.pandas.Series(values, dtype=object, index=range(10, 10 + len(values)), name='Cor')
+    expected = series.apply(lambda x: depara.get(tse.slugify(str(x).strip()), 0))
+    result = tse.TSE_parse.map_depara(series, depara)
+    assert result.tolist() == expected.tolist()
+    assert result.index.tolist() == expected.index.tolist()
+    assert result.name == expected.name
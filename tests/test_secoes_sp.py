@@ -0,0 +1,96 @@
+import pandas
+import pytest
+
+import tse_parse_secoes_sp as secoes
+
+File_SecoesSP = secoes.File_SecoesSP
+
+
+@pytest.fixture
+def estado():
+    ## Special sections inside the ordinary ranges, of the same and of
+    ## another polling place, and a section listed by two places
+    return pandas.DataFrame([
+        ('1a ZONA', 'Escola A', 'Rua 1', 'SAO PAULO', 'Da 1ª à 20ª; 22ª', '5ª; 21ª'),
+        ('1a ZONA', 'Escola B', 'Rua 2', 'SAO PAULO', 'Da 30ª à 35ª', '12ª'),
+        ('2a ZONA', 'Escola C', 'Rua 3', 'SANTOS', 'Da 1ª à 5ª.', None),
+        ('2a ZONA', 'Escola D', 'Rua 4', 'SANTOS', '5ª', None),
+    ], columns=['Nome', 'Local', 'Endereço', 'Município', 'Seções', 'SeçõesEspeciais'])
+
+
+@pytest.fixture
+def capital():
+    ## The first range of the state file spans two Bairros, and the 3a
+    ## ZONA is only in the capital file
+    return pandas.DataFrame([
+        ('Centro', '1a ZONA', 'Escola A', 'Rua 1', 'Da 1ª à 10ª', '5ª'),
+        ('Se', '1a ZONA', 'Escola A', 'Rua 1', 'Da 11ª à 21ª', None),
+        ('Liberdade', '3a ZONA', 'Escola E', 'Rua 5', 'Da 1ª à 9ª', '4ª'),
+    ], columns=['Bairro', 'Nome', 'Local', 'Endereço', 'Seções', 'SeçõesEspeciais'])
+
+
+def old_merge(estado, capital):
+    """
+    main() as it was before the ranges, one row per section.
+    """
+    index = ['Zona', 'Seção']
+    columns = ['Nome', 'Local', 'Endereço', 'Município', 'Bairro', 'Especial']
+    return (
+        File_SecoesSP.normalize(estado)
+        .merge(File_SecoesSP.normalize(capital)[index+['Bairro']], how='outer', on=index)
+        .sort_values(by=index)
+        [index+columns]
+        .reset_index(drop=True)
+    )
+
+
+def test_lookup_same_as_sections(estado):
+    ## A section listed by two places is found in the special one; one
+    ## listed by two ordinary ranges is ambiguous, and left out
+    expected = File_SecoesSP.normalize(estado)
+    ordinary = expected[~expected['Especial']]
+    ambiguous = ordinary[ordinary.duplicated(subset=['Zona', 'Seção'], keep=False)]
+    expected = (
+        expected[~expected.set_index(['Zona', 'Seção']).index.isin(ambiguous.set_index(['Zona', 'Seção']).index)]
+        .sort_values(by=['Zona', 'Seção', 'Especial'], ascending=[True, True, False], kind='stable')
+        .drop_duplicates(subset=['Zona', 'Seção'])
+        .reset_index(drop=True)
+    )
+    assert expected['Especial'].sum() == 3
+    columns = ['Nome', 'Local', 'Especial']
+    result = File_SecoesSP.lookup(
+        expected[['Zona', 'Seção']],
+        File_SecoesSP.intervalos(estado),
+        columns,
+    )
+    assert result[columns].to_dict('records') == expected[columns].to_dict('records')
+
+
+def test_merge_same_as_old(estado, capital):
+    result = File_SecoesSP.merge(estado, capital)
+    expected = old_merge(estado, capital)
+    pandas.testing.assert_frame_equal(result, expected)
+    bairros = dict(zip(zip(result['Zona'], result['Seção']), result['Bairro']))
+    assert bairros[(1, 10)] == 'Centro'
+    assert bairros[(1, 11)] == 'Se'
+    assert bairros[(3, 9)] == 'Liberdade'
+    assert (result['Zona'] == 3).sum() == 9
+
+
+def test_intervals_back_to_sections(estado, capital):
+    secoes = File_SecoesSP.merge(estado, capital)
+    intervalos = File_SecoesSP.collapse(secoes)
+    assert len(intervalos) < len(secoes)
+    expanded = File_SecoesSP.expand_intervalos(intervalos)[secoes.columns]
+    pandas.testing.assert_frame_equal(expanded, secoes, check_dtype=False)
+    ## The ranges only in the capital file are found by lookup too
+    secoes = secoes[~secoes.duplicated(subset=['Zona', 'Seção'], keep=False)].reset_index(drop=True)
+    assert (secoes['Zona'] == 3).sum() == 9
+    columns = ['Local', 'Bairro']
+    result = File_SecoesSP.lookup(secoes[['Zona', 'Seção']], intervalos, columns)
+    pandas.testing.assert_frame_equal(result[columns], secoes[columns], check_dtype=False)
+
+
+def test_nome_needs_a():
+    assert File_SecoesSP.parse_string_nome('1a ZONA') == 1
+    assert File_SecoesSP.parse_string_nome('1ª ZONA') is None
@@ -0,0 +1,30 @@
+import os
+import random
+
+import pytest
+
+import tse_benchmark
+import tse_download_repositorio as tse
+
+
+@pytest.mark.parametrize('to_numeric', [False, True])
+@pytest.mark.parametrize('main', [tse.Main_demografia_zona, tse.Main_candidatos, tse.Main_votacao_secao])
+def test_parquet_years_share_schema(main, to_numeric, tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    dataset = pytest.importorskip('pyarrow.dataset')
+    monkeypatch.setattr(tse.TSE_write_parquet, 'folder', str(tmp_path))
+    parser = main.class_parser
+    layouts = tse.TSE_schemas.layouts(parser.dataset, main.parser_kwargs.get('nivel'))
+    assert len(layouts) == 2
+    rows = 0
+    for layout in layouts:
+        ano = tse_benchmark.Fixtures.ano(layout)
+        content = tse_benchmark.Fixtures.member(layout, parser, ano, ['AC'], 20, random.Random(0))
+        df = parser.parse(content, ano=ano, **dict(main.parser_kwargs, to_numeric=to_numeric))
+        writer = tse.TSE_write_parquet(tse.TSE_write_parquet.path(main, ano=ano, estado='AC'), parser)
+        writer.write(df)
+        writer.close()
+        rows += len(df)
+    name = main.save_name.split('_')[0]
+    table = dataset.dataset(os.path.join(str(tmp_path), name), partitioning='hive').to_table()
+    assert table.num_rows == rows
@@ -0,0 +1,515 @@
+import pandas
+import logging
+import os
+import sys
+import io
+import json
+import time
+import random
+import glob
+import zipfile
+import contextlib
+import shutil
+import tempfile
+import argparse
+import resource
+import subprocess
+import threading
+import functools
+import statistics
+import http.server
+import multiprocessing
+import re
+
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import tse_download_repositorio as tse
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger()
+
+
+class Fixtures:
+    """
+    Synthetic files in every layout of tse_schemas.json, with the names,
+    encoding (latin1), quoting and '#NULO#'/'#NE#' sentinels of the files
+    in the TSE repository. Each case is one (Main class, layout) pair.
+    """
+
+    casos = [
+        ('Main_demografia_zona', 'perfil_eleitorado/perfil_eleitorado_{ano}.zip', 'perfil_eleitorado_{ano}.csv'),
+        ('Main_demografia_secao', 'perfil_eleitor_secao/perfil_eleitor_secao_{ano}_{estado}.zip', 'perfil_eleitor_secao_{ano}_{estado}.csv'),
+        ('Main_candidatos', 'consulta_cand/consulta_cand_{ano}.zip', 'consulta_cand_{ano}_{estado}.csv'),
+        ('Main_votacao_candidato_zona', 'votacao_candidato_munzona/votacao_candidato_munzona_{ano}.zip', 'votacao_candidato_munzona_{ano}_{estado}.csv'),
+        ('Main_votacao_secao', 'votacao_secao/votacao_secao_{ano}_{estado}.zip', 'votacao_secao_{ano}_{estado}.csv'),
+        ('Main_votacao_detalhesecao', 'detalhe_votacao_secao/detalhe_votacao_secao_{ano}.zip', 'detalhe_votacao_secao_{ano}_{estado}.csv'),
+    ]
+    textos = ['SÃO PAULO', 'JOSÉ DA SILVA', 'ELEIÇÃO GERAL', 'MARIA APARECIDA', 'PARTIDO DA NAÇÃO', 'AÇAÍ']
+    sentinelas = ['#NULO#', '#NE#']
+
+    @staticmethod
+    def ano(layout):
+        anos = layout['anos']
+        return anos.get('desde', anos.get('ate'))
+
+    @classmethod
+    def value(cls, name, ano, estado, parser, rng):
+        depara = getattr(parser, 'tabelas_depara', {})
+        if name in depara:
+            return rng.choice(list(depara)).replace('-', ' ').upper()
+        if rng.random() < 0.05 and name not in ['Ano', 'UF', 'Município', 'Zona', 'Seção']:
+            return rng.choice(cls.sentinelas)
+        if name == 'Ano':
+            return str(ano)
+        if name in ['UF', 'UE', 'Nascimento_UF']:
+            return estado
+        if name in ['Município', 'Nascimento_município']:
+            return '{:05d}'.format(rng.randint(1, 99999))
+        if name == 'Zona':
+            return str(rng.randint(1, 400))
+        if name == 'Seção':
+            return str(rng.randint(1, 900))
+        if name.endswith('_data'):
+            return '{:02d}/{:02d}/{}'.format(rng.randint(1, 28), rng.randint(1, 12), rng.randint(1930, 2000))
+        ## Within the ranges of the real files, which fit their dtypes
+        if name.startswith('Votos') or name.startswith('Quantidade'):
+            return str(rng.randint(0, 500))
+        if name == 'Turno':
+            return str(rng.randint(1, 2))
+        if name == 'Cargo':
+            return str(rng.randint(1, 13))
+        if name == 'Idade':
+            return str(rng.randint(18, 90))
+        if name == 'Partido_número':
+            return str(rng.randint(10, 90))
+        if name == 'Urna_número':
+            return str(rng.randint(10, 99999))
+        if name in ['id', 'Coligação_código'] or name.startswith('Documento'):
+            return str(rng.randint(10, 10**11))
+        if name == 'Despesa':
+            return '{:.2f}'.format(rng.random() * 10**6)
+        return rng.choice(cls.textos)
+
+    @classmethod
+    def member(cls, layout, parser, ano, estados, linhas, rng):
+        """
+        Returns the content of one CSV member, as the TSE writes it.
+        """
+        if layout['header'] == 0:
+            sources = ['DT_GERACAO', 'HH_GERACAO'] + [x[0] for x in layout['columns']]
+            names = dict((x[0], x[1]) for x in layout['columns'])
+            lines = [';'.join('"{}"'.format(x) for x in sources)]
+        else:
+            sources = list(range(layout.get('campos', max(x[0] for x in layout['columns']) + 3)))
+            names = dict((x[0], x[1]) for x in layout['columns'])
+            lines = []
+        for n in range(linhas):
+            estado = estados[n % len(estados)]
+            lines.append(';'.join(
+                '"{}"'.format(cls.value(names[x], ano, estado, parser, rng) if x in names else 'X')
+                for x in sources
+            ))
+        return ('\n'.join(lines) + '\n').encode('latin1')
+
+    @classmethod
+    def build(cls, folder, linhas=20000, estados=None, seed=0):
+        """
+        Writes the ZIP files under folder, in the paths used by the TSE
+        repository, and returns the list of cases.
+        """
+        rng = random.Random(seed)
+        estados = estados or ['AC', 'SP']
+        cases = []
+        for main_name, path, member in cls.casos:
+            main = getattr(tse, main_name)
+            parser = main.class_parser
+            nivel = main.parser_kwargs.get('nivel')
+            for layout in tse.TSE_schemas.layouts(parser.dataset, nivel):
+                ano = cls.ano(layout)
+                for estado in (estados if '{estado}' in path else [None]):
+                    zip_path = path.format(ano=ano, estado=estado)
+                    zip_full = os.path.join(folder, zip_path)
+                    os.makedirs(os.path.dirname(zip_full), exist_ok=True)
+                    with zipfile.ZipFile(zip_full, 'w', zipfile.ZIP_DEFLATED) as zipped:
+                        for uf in ([estado] if estado else estados):
+                            content = cls.member(layout, parser, ano, [uf] if '{estado}' in member else estados, linhas, rng)
+                            zipped.writestr(member.format(ano=ano, estado=uf), content)
+                            if '{estado}' not in member:
+                                break
+                    cases.append(dict(
+                        main=main_name,
+                        layout='{}:{}'.format(parser.dataset, layout['nome']),
+                        ano=ano,
+                        estado=estado,
+                        path=zip_path,
+                    ))
+        return cases
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the files as the TSE repository does: with an ETag, and only
+    the rest of a file for a Range request whose If-Range still matches.
+    """
+
+    exp_range = re.compile(r'^bytes=([0-9]+)-$')
+
+    def log_message(self, *args):
+        pass
+
+    @staticmethod
+    def etag(path):
+        stat = os.stat(path)
+        return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        etag = self.etag(path)
+        last_modified = self.date_time_string(int(os.path.getmtime(path)))
+        match = self.exp_range.match(self.headers.get('Range', ''))
+        start = 0
+        if match and self.headers.get('If-Range', etag) in [etag, last_modified]:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        flread = open(path, 'rb')
+        flread.seek(start)
+        return flread
+
+
+class FlakyHandler(Handler):
+    """
+    Fails the first requests for each file: the first one with a 503, the
+    second one by closing the connection halfway through the body, which
+    the next request resumes. Files
+    that do not exist are answered with an HTML page and status 200, as
+    some servers do.
+    """
+
+    requests = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            body = b'<html><body>Pagina nao encontrada</body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        with self.lock:
+            count = self.requests.get(self.path, 0)
+            self.requests[self.path] = count + 1
+        if count == 0:
+            self.send_error(503)
+        elif count == 1:
+            with open(path, 'rb') as flread:
+                body = flread.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', self.etag(path))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            super().do_GET()
+
+
+class Server:
+    """
+    Local stand-in for agencia.tse.jus.br, serving the files of a folder.
+    """
+
+    def __init__(self, folder, handler=None):
+        handler = functools.partial(handler or Handler, directory=folder)
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def get_rss_mb():
+    ## ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def redirect(url, folder):
+    tse.TSE_download.url = url
+    tse.TSE_download.folder_save = os.path.join(folder, 'originals')
+    for main_name, _, _ in Fixtures.casos:
+        main = getattr(tse, main_name)
+        main.folder = os.path.join(folder, 'refined')
+    tse.TSE_write_parquet.folder = os.path.join(folder, 'refined', 'parquet')
+    os.makedirs(os.path.join(folder, 'refined'), exist_ok=True)
+
+
+def member_size(zip_full):
+    with zipfile.ZipFile(zip_full) as zipped:
+        return sum(x.file_size for x in zipped.infolist())
+
+
+def stage_download(case, url, folder, **kwargs):
+    redirect(url, folder)
+    start = time.perf_counter()
+    tse.TSE_download.download(case['path'], stream=True)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(os.path.join(tse.TSE_download.folder_save, 'zipped', case['path']))
+    return dict(rows=None, bytes=size, seconds=seconds)
+
+
+def stage_download_flaky(case, url, folder, **kwargs):
+    """
+    Same as stage_download, against a server that fails before serving
+    each file. Missing files must be rejected, not saved.
+    """
+    tse.TSE_download_manager.backoff = 0.01
+    with Server(kwargs['fixtures'], FlakyHandler) as server:
+        redirect(server.url, folder)
+        start = time.perf_counter()
+        tse.TSE_download.download(case['path'], stream=True)
+        seconds = time.perf_counter() - start
+        try:
+            tse.TSE_download.download(case['path'] + '.missing.zip', stream=True)
+            raise AssertionError('HTML page saved as a ZIP file')
+        except IOError:
+            pass
+    save_name = os.path.join(tse.TSE_download.folder_save, 'zipped', case['path'])
+    if not zipfile.is_zipfile(save_name):
+        raise AssertionError('Invalid ZIP file: {}'.format(save_name))
+    return dict(rows=None, bytes=os.path.getsize(save_name), seconds=seconds)
+
+
+def stage_decompress(case, url, folder, **kwargs):
+    zip_full = os.path.join(kwargs['fixtures'], case['path'])
+    start = time.perf_counter()
+    size = 0
+    with zipfile.ZipFile(zip_full) as zipped:
+        for name in zipped.namelist():
+            with zipped.open(name) as flread:
+                while True:
+                    chunk = flread.read(2**20)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+    return dict(rows=None, bytes=size, seconds=time.perf_counter() - start)
+
+
+def stage_parse(case, url, folder, **kwargs):
+    main = getattr(tse, case['main'])
+    zip_full = os.path.join(kwargs['fixtures'], case['path'])
+    rows, size, seconds = 0, 0, 0
+    with zipfile.ZipFile(zip_full) as zipped:
+        for name in zipped.namelist():
+            with zipped.open(name) as flread:
+                content = flread.read()
+            start = time.perf_counter()
+            if kwargs.get('chunksize'):
+                for df in main.class_parser.parse_chunks(content, ano=case['ano'], chunksize=kwargs['chunksize'], **main.parser_kwargs):
+                    rows += len(df)
+            else:
+                rows += len(main.class_parser.parse(content, ano=case['ano'], **main.parser_kwargs))
+            seconds += time.perf_counter() - start
+            size += len(content)
+    return dict(rows=rows, bytes=size, seconds=seconds)
+
+
+def stage_main(case, url, folder, **kwargs):
+    redirect(url, folder)
+    main = getattr(tse, case['main'])
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.main(ano=case['ano'], estado=case['estado'], force=True, stream=True, chunksize=kwargs.get('chunksize'))
+    seconds = time.perf_counter() - start
+    rows = 0
+    for path in glob.glob(os.path.join(folder, 'refined', '*.csv')):
+        with open(path, 'rb') as flread:
+            rows += sum(1 for _ in flread) - 1
+    size = member_size(os.path.join(tse.TSE_download.folder_save, 'zipped', case['path']))
+    return dict(rows=rows, bytes=size, seconds=seconds)
+
+
+STAGES = {
+    'download': stage_download,
+    'download_flaky': stage_download_flaky,
+    'decompress': stage_decompress,
+    'parse': stage_parse,
+    'main': stage_main,
+}
+
+
+def run_stage(stage, case, url, folder, **kwargs):
+    """
+    Runs one stage in the current process, which is a fresh one, so that
+    the peak RSS belongs to that stage alone.
+    """
+    rss_start = get_rss_mb()
+    result = STAGES[stage](case, url, folder, **kwargs)
+    result.update(
+        stage=stage,
+        case='{}|{}|{}'.format(case['layout'], case['ano'], case['estado'] or 'BR'),
+        rss_start_mb=rss_start,
+        rss_peak_mb=get_rss_mb(),
+    )
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def benchmark(stages, linhas=20000, estados=None, chunksize=None, seed=0):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='tse_benchmark_') as folder:
+        fixtures = os.path.join(folder, 'fixtures')
+        cases = Fixtures.build(fixtures, linhas=linhas, estados=estados, seed=seed)
+        with Server(fixtures) as server:
+            for case in cases:
+                for stage in stages:
+                    work = os.path.join(folder, 'work')
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        result = pool.submit(
+                            run_stage, stage, case, server.url, work,
+                            fixtures=fixtures, chunksize=chunksize,
+                        ).result()
+                    results.append(result)
+                    ## Each stage starts from an empty cache
+                    shutil.rmtree(work, ignore_errors=True)
+    df = pandas.DataFrame(results)
+    df['MB'] = df['bytes'] / 2**20
+    df['MB/s'] = df['MB'] / df['seconds']
+    df['rows/s'] = df['rows'] / df['seconds']
+    return df[['stage', 'case', 'rows', 'MB', 'seconds', 'rows/s', 'MB/s', 'rss_start_mb', 'rss_peak_mb']]
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'urllib3', 'slugify', 'pyarrow', 'zstandard', 'pgzip', 'duckdb']
+
+
+def run_startup(command, env):
+    """
+    Wall time of a fresh interpreter running the command, and the heavy
+    modules it imported, from the report of -X importtime.
+    """
+    start = time.perf_counter()
+    done = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + command,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+        ## A run that goes to the network instead of finding the outputs
+        timeout=60,
+    )
+    seconds = time.perf_counter() - start
+    imported = {x.split('|')[-1].strip() for x in done.stderr.splitlines() if x.startswith('import time:')}
+    return seconds, sorted(x for x in HEAVY_MODULES if x in imported)
+
+
+
+def benchmark_startup(repeticoes=5):
+    """
+    Times the import of tse_download_repositorio and a run of
+    --dados candidatos in which every output already exists, each in a
+    new process, with a HOME in which the outputs of every state were
+    created empty.
+    """
+    commands = {
+        'import': ['-c', 'import tse_download_repositorio'],
+        'found': ['tse_download_repositorio.py', '--dados', 'candidatos'],
+    }
+    results = []
+    with tempfile.TemporaryDirectory(prefix='tse_benchmark_') as home:
+        folder = os.path.join(home, os.path.relpath(tse.Main_candidatos.folder, os.path.expanduser('~')))
+        os.makedirs(folder)
+        for ano in tse.Main_candidatos.anos:
+            ## One output per state of the national archive
+            for estado in tse.ESTADOS_TODOS:
+                open(os.path.join(folder, tse.Main_candidatos.save_name.format(ano=ano, estado=estado)), 'w').close()
+        env = dict(os.environ, HOME=home)
+        for stage, command in commands.items():
+            runs = [run_startup(command, env) for _ in range(repeticoes)]
+            seconds = [x[0] for x in runs]
+            results.append(dict(
+                stage=stage,
+                seconds=statistics.median(seconds),
+                seconds_min=min(seconds),
+                modules=','.join(runs[-1][1]),
+            ))
+    return pandas.DataFrame(results)
+
+
+def main():
+
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--etapas', default=','.join(STAGES))
+    arguments.add_argument('--linhas', type=int, default=20000)
+    arguments.add_argument('--estados', default='AC,SP')
+    arguments.add_argument('--chunksize', type=int, default=None)
+    arguments.add_argument('--json', default=None)
+    arguments.add_argument('--inicio', action='store_true')
+    arguments.add_argument('--repeticoes', type=int, default=5)
+    parsed = arguments.parse_args()
+
+    if parsed.inicio:
+        df = benchmark_startup(repeticoes=parsed.repeticoes)
+    else:
+        df = benchmark(
+            parsed.etapas.split(','),
+            linhas=parsed.linhas,
+            estados=parsed.estados.split(','),
+            chunksize=parsed.chunksize,
+        )
+    with pandas.option_context('display.width', 200, 'display.max_rows', None):
+        print(df.to_string(index=False, float_format='{:.2f}'.format))
+
+    if parsed.json:
+        header = dict(
+            commit=get_commit(),
+            data=datetime.now().isoformat(timespec='seconds'),
+            linhas=parsed.linhas,
+            chunksize=parsed.chunksize,
+        )
+        with open(parsed.json, 'a') as flsave:
+            for record in df.to_dict(orient='records'):
+                flsave.write(json.dumps(dict(header, **record), ensure_ascii=False, default=str) + '\n')
+    return df
+
+if __name__ == '__main__':
+    main()
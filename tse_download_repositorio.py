@@ -1,15 +1,85 @@
-import requests
 import zipfile
 import io
-import pandas
 import logging
 import os
 import re
 import argparse
+import json
+import threading
+import urllib.parse
+import shutil
+import time
+import contextlib
+import tempfile
+import difflib
+import gzip
+import queue
+import hashlib
+import socket
+import uuid
+import collections
+import importlib
+import importlib.util
 
 
-from slugify import slugify
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class LazyModule:
+    """
+    Stands for a module, which is imported on the first access to one of
+    its attributes. The import goes through importlib, whose module locks
+    make threads that use the module at the same time wait for it to be
+    fully imported.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazy_import(name, optional=False):
+    """
+    Returns the module as a LazyModule, or None if it is optional and not
+    installed. The heavy modules are imported like this, so that a run in
+    which every output already exists does not pay for them.
+    """
+    if importlib.util.find_spec(name) is None:
+        if optional:
+            return None
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    return LazyModule(name)
+
+
+pandas = lazy_import('pandas')
+numpy = lazy_import('numpy')
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
+pyarrow = lazy_import('pyarrow', optional=True)
+pgzip = lazy_import('pgzip', optional=True)
+zstandard = lazy_import('zstandard', optional=True)
+tse_warehouse = lazy_import('tse_warehouse')
+_slugify = lazy_import('slugify')
+
+
+def slugify(text, **kwargs):
+    return _slugify.slugify(text, **kwargs)
+
 
 ESTADOS_TODOS = [
     'AC', 'RR', 'TO', 'PA', 'AM', 'AP', 'RO',
@@ -20,37 +90,289 @@ ESTADOS_TODOS = [
     'SP', 
 ]
 
+class TSE_download_manager:
+    """
+    Downloads files to disk, resuming interrupted downloads with HTTP Range
+    requests and keeping a JSON manifest for each file. All requests go
+    through one pooled session, with timeouts; 5xx responses, connection
+    errors and downloads cut short are retried with exponential backoff.
+    Responses that are not ZIP files (such as HTML error pages) are
+    rejected before anything is saved.
+    """
+
+    chunk_size = 1024 * 1024
+    max_per_host = 2
+    timeout = (10, 120)
+    retries = 5
+    backoff = 1.
+    status_retry = [500, 502, 503, 504]
+    invalid_types = ['text/html', 'text/plain']
+    zip_magic = [b'PK\x03\x04', b'PK\x05\x06']
+    _session = None
+    _host_slots = {}
+    _host_lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        with cls._host_lock:
+            if cls._session is None:
+                ## No retries here: retrying is the only retry layer
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=max(10, 2 * cls.max_per_host),
+                )
+                cls._session = requests.Session()
+                cls._session.mount('http://', adapter)
+                cls._session.mount('https://', adapter)
+            return cls._session
+
+    @classmethod
+    def transient(cls):
+        return (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            urllib3.exceptions.HTTPError,
+        )
+
+    @classmethod
+    def is_transient(cls, error):
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in cls.status_retry
+        return isinstance(error, cls.transient())
+
+    @classmethod
+    def retrying(cls, function, *args, **kwargs):
+        """
+        Calls the function, again after 1, 2, 4, ... times backoff
+        seconds if it fails with a transient error or a 5xx response.
+        """
+        for attempt in range(cls.retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except (requests.RequestException, *cls.transient()) as error:
+                if attempt == cls.retries or not cls.is_transient(error):
+                    raise
+                delay = cls.backoff * 2**attempt
+                logging.warning(f'{error}; retrying in {delay:.0f} s')
+                time.sleep(delay)
+
+    @classmethod
+    def validate(cls, response, url):
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type in cls.invalid_types:
+            raise IOError(f'Not a ZIP file ({content_type}): {url}')
+
+    @classmethod
+    def is_zip(cls, head):
+        return any(head.startswith(x) for x in cls.zip_magic)
+
+    @classmethod
+    def get(cls, url):
+        """
+        Returns the content of a ZIP file, without saving it.
+        """
+        def get_once():
+            with cls.host_slot(url):
+                req = cls.session().get(url, timeout=cls.timeout)
+            cls.validate(req, url)
+            return req.content
+        content = cls.retrying(get_once)
+        if not cls.is_zip(content[:4]):
+            raise IOError(f'Not a ZIP file: {url}')
+        logging.info(f'Done')
+        return content
+
+    @classmethod
+    def host_slot(cls, url):
+        """
+        Limits the number of simultaneous requests to the same host.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with cls._host_lock:
+            if host not in cls._host_slots:
+                cls._host_slots[host] = threading.BoundedSemaphore(cls.max_per_host)
+            return cls._host_slots[host]
+
+    @classmethod
+    def read_manifest(cls, manifest_name):
+        try:
+            with open(manifest_name, 'r') as flread:
+                return json.load(flread)
+        except (OSError, ValueError):
+            return {}
+
+    @classmethod
+    def write_manifest(cls, manifest_name, manifest):
+        folder = os.path.dirname(manifest_name)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp_name = manifest_name + '.tmp'
+        with open(temp_name, 'w') as flsave:
+            json.dump(manifest, flsave, indent=1, sort_keys=True)
+        os.replace(temp_name, manifest_name)
+
+    @staticmethod
+    def remote_headers(response):
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+    @classmethod
+    def check(cls, url, save_name, manifest_name, **kwargs):
+        """
+        Returns True if the local copy of the file can be used.
+        """
+        if not os.path.exists(save_name):
+            return False
+        manifest = cls.read_manifest(manifest_name)
+        size = os.path.getsize(save_name)
+        if manifest.get('status') != 'complete' or manifest.get('size') != size:
+            if manifest or not zipfile.is_zipfile(save_name):
+                ## Half-written file: keep it as a partial download
+                os.replace(save_name, save_name + '.part')
+                return False
+            ## Files saved before the manifest existed
+            manifest = dict(url=url, status='complete', size=size, content_length=size)
+            cls.write_manifest(manifest_name, manifest)
+        if kwargs.get('revalidate'):
+            def head_once():
+                with cls.host_slot(url):
+                    req = cls.session().head(url, allow_redirects=True, timeout=cls.timeout)
+                if req.status_code in cls.status_retry:
+                    req.raise_for_status()
+                return req
+            try:
+                req = cls.retrying(head_once)
+            except requests.HTTPError as error:
+                req = error.response
+            if not req.ok:
+                logging.warning(f'Could not revalidate {url}: HTTP {req.status_code}')
+                return True
+            remote = cls.remote_headers(req)
+            length = req.headers.get('Content-Length')
+            changed = (
+                (length is not None and int(length) != manifest.get('content_length'))
+                or any(
+                    remote[key] and remote[key] != manifest.get(key)
+                    for key in ['etag', 'last_modified']
+                )
+            )
+            if changed:
+                logging.info(f'Remote file changed: {url}')
+                os.remove(save_name)
+                return False
+        return True
+
+    @classmethod
+    def fetch(cls, url, save_name, manifest_name, **kwargs):
+        ## Retried attempts resume from the partial file
+        return cls.retrying(cls.fetch_once, url, save_name, manifest_name, **kwargs)
+
+    @classmethod
+    def fetch_once(cls, url, save_name, manifest_name, **kwargs):
+        folder = os.path.dirname(save_name)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        part_name = save_name + '.part'
+        manifest = cls.read_manifest(manifest_name)
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+
+        headers = {}
+        validator = manifest.get('etag') or manifest.get('last_modified')
+        if offset and validator:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+
+        chunk_size = kwargs.get('chunk_size', cls.chunk_size)
+        with cls.host_slot(url), cls.session().get(url, headers=headers, stream=True, timeout=cls.timeout) as req:
+            retry = req.status_code == 416
+            if retry:
+                ## The partial file is not valid for the remote one
+                os.remove(part_name)
+            else:
+                cls.validate(req, url)
+                if req.status_code == 206:
+                    content_length = int(req.headers['Content-Range'].split('/')[-1])
+                    mode = 'ab'
+                else:
+                    length = req.headers.get('Content-Length')
+                    content_length = int(length) if length is not None else None
+                    mode = 'wb'
+                    offset = 0
+                manifest = dict(
+                    url=url,
+                    status='partial',
+                    content_length=content_length,
+                    **cls.remote_headers(req),
+                )
+                cls.write_manifest(manifest_name, manifest)
+                if offset:
+                    logging.info(f'Resuming from byte {offset}')
+                with open(part_name, mode) as flsave:
+                    ## Raw bytes, so the size matches Content-Length
+                    for chunk in req.raw.stream(chunk_size, decode_content=False):
+                        flsave.write(chunk)
+        if retry:
+            return cls.fetch_once(url, save_name, manifest_name, **kwargs)
+
+        size = os.path.getsize(part_name)
+        if content_length is not None and size != content_length:
+            raise urllib3.exceptions.ProtocolError(f'Incomplete download of {url}: {size} of {content_length} bytes')
+        with open(part_name, 'rb') as flread:
+            if not cls.is_zip(flread.read(4)):
+                os.remove(part_name)
+                raise IOError(f'Not a ZIP file: {url}')
+        os.replace(part_name, save_name)
+        manifest.update(
+            status='complete',
+            size=size,
+            downloaded=datetime.now().isoformat(timespec='seconds'),
+        )
+        cls.write_manifest(manifest_name, manifest)
+        logging.info(f'Done')
+        return save_name
+
+
 class TSE_download():
     
     url = 'http://agencia.tse.jus.br/estatistica/sead/odsele/'
     folder_save = os.path.expanduser('~/localdatalake/tse_raw/originals')
+    manager = TSE_download_manager
+    exp_estado = re.compile('_([A-Z]{2})\\.[A-Za-z]{3}$')
     
     @classmethod
     def download(cls, path='', **kwargs):
 
         ## First, check the already downloaded files
+        this_url = os.path.join(cls.url, path)
         save_name = os.path.join(cls.folder_save, 'zipped', path)
-        if os.path.exists(save_name):
-            print('Reading local file: {}'.format(save_name))
-            with open(save_name, 'rb') as flread:
-                content = io.BytesIO(flread.read())
-        else:
-            this_url = os.path.join(cls.url, path)
-            req = requests.get(this_url)
-            try:
-                content = io.BytesIO(req.content)
-                logging.info(f'Done')
-            except zipfile.BadZipFile:
-                logging.error(f'Not a valid file')
-                return None
+        manifest_name = os.path.join(cls.folder_save, 'manifest', path + '.json')
+        with TSE_trace.span('download', arquivo=path) as span:
+            if cls.manager.check(this_url, save_name, manifest_name, **kwargs):
+                print('Reading local file: {}'.format(save_name))
+                span.record['local'] = True
+                if kwargs.get('stream', False):
+                    content = save_name
+                else:
+                    with open(save_name, 'rb') as flread:
+                        content = io.BytesIO(flread.read())
+            elif kwargs.get('stream', False) or kwargs.get('save', False):
+                cls.manager.fetch(this_url, save_name, manifest_name, **kwargs)
+                content = save_name
+            else:
+                content = io.BytesIO(cls.manager.get(this_url))
+            if isinstance(content, str):
+                span.add(bytes_out=os.path.getsize(content))
+            else:
+                span.add(bytes_out=content.getbuffer().nbytes)
 
         if kwargs.get('save', False):
-            save_name = os.path.join(cls.folder_save, 'zipped', path)
-            folder = os.path.dirname(save_name)
-            if not os.path.isdir(folder):
-                os.makedirs(folder)
-            with open(save_name, 'wb') as flsave:
-                flsave.write(content.read())
+            ## Saved files are written by the download manager
+            return None
         elif kwargs.get('save_unzipped', False):
             zipped = zipfile.ZipFile(content)
             for name in zipped.namelist():
@@ -61,6 +383,12 @@ class TSE_download():
                 with open(save_name, 'wb') as flsave:
                     with zipped.open(name) as flread:
                         flsave.write(flread.read())
+        elif kwargs.get('members'):
+            return cls.iter_members(
+                zipfile.ZipFile(content),
+                pattern=kwargs.get('pattern'),
+                estados=kwargs.get('estados'),
+            )
         elif kwargs.get('return_unzipped'):
             files = {}
             zipped = zipfile.ZipFile(content)
@@ -75,17 +403,59 @@ class TSE_download():
                 return None
 
     @classmethod
-    def read_files(cls, file_dict, header=0):
-        dataframes = {}
-        for name, fl in file_dict.items():
+    def member_names(cls, zipped, pattern=None, estados=None):
+        """
+        Returns the names of the CSV and TXT members of the archive, only
+        those matching a regular expression or of some UFs (taken from the
+        name, as in votacao_secao_2018_SP.csv) if given. Nothing is
+        decompressed.
+        """
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        names = []
+        for name in zipped.namelist():
+            basename = os.path.basename(name)
+            if not (name.endswith('txt') or name.endswith('csv')):
+                continue
+            if pattern and not pattern.search(basename):
+                continue
+            if estados:
+                match = cls.exp_estado.search(basename)
+                if not match or match.group(1) not in estados:
+                    continue
+            names.append(name)
+        return names
+
+    @classmethod
+    def iter_members(cls, zipped, pattern=None, estados=None):
+        """
+        Yields the (name, stream) of the members of the archive, filtered
+        as in member_names. Each member is opened when it is reached and
+        closed when the next one is requested, so a single one is held
+        at a time.
+        """
+        for name in cls.member_names(zipped, pattern=pattern, estados=estados):
+            with zipped.open(name) as flread:
+                yield name, flread
+
+    @classmethod
+    def iter_frames(cls, members, header=0):
+        """
+        Yields the (name, DataFrame) of each (name, content) pair, where the
+        content is either bytes or a stream, as given by iter_members.
+        """
+        for name, fl in members:
             if name.endswith('.csv') or name.endswith('txt'):
-                dataframes['.'.join(name.split('.')[:-1])] = pandas.read_csv(
-                    io.BytesIO(fl),
+                yield '.'.join(name.split('.')[:-1]), pandas.read_csv(
+                    io.BytesIO(fl) if isinstance(fl, bytes) else fl,
                     sep=';',
                     header=header,
                     encoding='latin1',
                 )
-        return dataframes
+
+    @classmethod
+    def read_files(cls, file_dict, header=0):
+        return dict(cls.iter_frames(file_dict.items(), header=header))
 
 class TSE_download_demografia_zona(TSE_download):
     @classmethod
@@ -153,8 +523,287 @@ class TSE_download_vagas(TSE_download):
         path = f'consulta_vagas/consulta_vagas_{ano}.zip'
         return super().download(path, **kwargs)
 
+class TSE_schema:
+    """
+    Layout of a TSE file: the (source, name) pairs of the columns to keep,
+    the columns this layout lacks and the header row. It compiles into
+    the arguments of read_csv, so that only the kept columns are read,
+    each one with its own dtype.
+    """
+
+    def __init__(self, columns, columns_extra=None, header=0, categorical=None, text_dtype='str', nome=None, versao=None):
+        self.columns = columns
+        self.columns_extra = columns_extra or []
+        self.header = header
+        self.categorical = categorical or []
+        self.text_dtype = text_dtype
+        self.nome = nome
+        self.versao = versao
+
+    def read_kwargs(self, **kwargs):
+        use_category = kwargs.get('use_category') or kwargs.get('use_categories')
+        dtype = {}
+        for source, name in self.columns:
+            if use_category and name in self.categorical:
+                dtype[source] = 'category'
+            elif self.text_dtype:
+                dtype[source] = self.text_dtype
+        return dict(
+            header=self.header,
+            usecols=[x[0] for x in self.columns],
+            dtype=dtype,
+        )
+
+    def select(self, df):
+        df = (
+            df
+            [[x[0] for x in self.columns]]
+            .rename(columns={x[0]: x[1] for x in self.columns})
+            .reset_index(drop=True)
+        )
+        for col in self.columns_extra:
+            df[col] = None
+        return df
+
+
+class TSE_schemas:
+    """
+    Registry of the layouts of each dataset, read from tse_schemas.json.
+    The layout of a file is detected from its first line: files with a
+    header by the column names, files without one by the number of fields.
+    The year of the election is only used when there is no first line.
+    """
+
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tse_schemas.json')
+    _registry = None
+
+    @classmethod
+    def registry(cls):
+        if cls._registry is None:
+            with open(cls.filename, 'r', encoding='utf-8') as flread:
+                cls._registry = json.load(flread)
+        return cls._registry
+
+    @classmethod
+    def versao(cls):
+        return cls.registry()['versao']
+
+    @classmethod
+    def layouts(cls, dataset, nivel=None):
+        return [
+            x for x in cls.registry()['layouts'][dataset]
+            if x.get('nivel') in [None, nivel]
+        ]
+
+    @staticmethod
+    def match_ano(anos, ano):
+        if str(ano) in anos.get('inclui', []):
+            return True
+        try:
+            ano = int(ano)
+        except (TypeError, ValueError):
+            return False
+        return anos.get('desde', ano) <= ano <= anos.get('ate', ano)
+
+    @staticmethod
+    def match_campos(layout, campos):
+        if 'campos' in layout:
+            return campos == layout['campos']
+        return max(x[0] for x in layout['columns']) < campos
+
+    @classmethod
+    def detect(cls, dataset, nivel=None, first_line=None, ano=None):
+        layouts = cls.layouts(dataset, nivel)
+        if first_line:
+            fields = [x.strip().strip('"') for x in first_line.split(';')]
+            headers = set(x[0] for layout in layouts if layout['header'] == 0 for x in layout['columns'])
+            if headers.intersection(fields):
+                for layout in layouts:
+                    if layout['header'] == 0 and all(x[0] in fields for x in layout['columns']):
+                        return layout
+                raise ValueError(f'Unknown header for {dataset}: {first_line[:200]}')
+            for layout in layouts:
+                if layout['header'] is None and cls.match_campos(layout, len(fields)):
+                    return layout
+            raise ValueError(f'Unknown layout for {dataset} with {len(fields)} fields')
+        for layout in layouts:
+            if cls.match_ano(layout['anos'], ano):
+                return layout
+        raise ValueError(f'Unknown layout for {dataset} in {ano}')
+
+
 class TSE_parse:
 
+    na_values = ['#NULO#', '#NE#']
+    read_kwargs = dict(na_values=na_values)
+    text_dtype = 'str'
+    categorical = []
+    ## Codes shared by the datasets, each subclass adding its own columns
+    dtypes_codigos = {
+        'Ano': 'int16',
+        'Turno': 'int8',
+        'Cargo': 'int16',
+        'Município': 'int32',
+        'Zona': 'int16',
+        'Seção': 'int16',
+    }
+    dtypes = {}
+    dates = []
+    tabelas_depara = {}
+    chunksize = 500000
+    cache = None
+    _schemas = {}
+
+    @classmethod
+    def schema(cls, ano=None, nivel=None, file_object=None):
+        layout = TSE_schemas.detect(
+            cls.dataset,
+            nivel=nivel,
+            first_line=cls.first_line(file_object),
+            ano=ano,
+        )
+        key = (cls.__name__, layout['nome'])
+        if key not in cls._schemas:
+            cls._schemas[key] = TSE_schema(
+                [tuple(x) for x in layout['columns']],
+                columns_extra=layout['columns_extra'],
+                header=layout['header'],
+                categorical=cls.categorical,
+                text_dtype=cls.text_dtype,
+                nome=layout['nome'],
+                versao=TSE_schemas.versao(),
+            )
+        return cls._schemas[key]
+
+    @staticmethod
+    def first_line(file_object):
+        """
+        Returns the first line of the file, leaving streams where they were.
+        """
+        if isinstance(file_object, bytes):
+            line = file_object.split(b'\n', 1)[0]
+        elif file_object is not None and file_object.seekable():
+            position = file_object.tell()
+            line = file_object.readline()
+            file_object.seek(position)
+        else:
+            return None
+        return line.decode('latin1').strip()
+
+    @classmethod
+    def read(cls, file_object, schema, chunksize=None, **kwargs):
+        if isinstance(file_object, bytes):
+            file_object = io.BytesIO(file_object)
+        if kwargs.get('engine') == 'pyarrow':
+            if chunksize:
+                raise ValueError("The 'chunksize' option is not supported with the 'pyarrow' engine")
+            return cls.read_pyarrow(file_object, schema, **kwargs)
+        if kwargs.get('engine'):
+            kwargs_engine = dict(engine=kwargs.get('engine'))
+        else:
+            kwargs_engine = dict()
+        return pandas.read_csv(
+            file_object,
+            sep=';',
+            encoding='latin1',
+            chunksize=chunksize,
+            **cls.read_kwargs,
+            **schema.read_kwargs(**kwargs),
+            **kwargs_engine,
+        )
+
+    @classmethod
+    def read_pyarrow(cls, file_object, schema, **kwargs):
+        """
+        Same as read, with the CSV reader of pyarrow. The pyarrow engine of
+        read_csv infers the types before applying the dtypes, dropping the
+        leading zeros of codes such as Município or Documento_CPF, so the
+        columns read as text are given to pyarrow as strings.
+        """
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed for engine=pyarrow')
+        csv = importlib.import_module('pyarrow.csv')
+        na_defaults = importlib.import_module('pandas._libs.parsers').STR_NA_VALUES
+        read_kwargs = schema.read_kwargs(**kwargs)
+        ## Files without a header have their columns named f0, f1, ...
+        names = {
+            source: source if schema.header == 0 else f'f{source}'
+            for source in read_kwargs['usecols']
+        }
+        table = csv.read_csv(
+            file_object,
+            read_options=csv.ReadOptions(
+                encoding='latin1',
+                autogenerate_column_names=schema.header is None,
+            ),
+            parse_options=csv.ParseOptions(delimiter=';'),
+            convert_options=csv.ConvertOptions(
+                include_columns=list(names.values()),
+                column_types={names[x]: pyarrow.string() for x in read_kwargs['dtype']},
+                ## The same missing values as read_csv
+                null_values=sorted(na_defaults) + cls.read_kwargs.get('na_values', []),
+                strings_can_be_null=True,
+            ),
+        )
+        df = table.to_pandas().rename(columns={v: k for k, v in names.items()})
+        return df.astype(read_kwargs['dtype'])
+
+    @classmethod
+    def parse(cls, file_object, ano, nivel=None, cache=True, **kwargs):
+        if cache and TSE_parse.cache is not None:
+            return TSE_parse.cache.parse(cls, file_object, ano, nivel=nivel, **kwargs)
+        schema = cls.schema(ano, nivel, file_object)
+        with TSE_trace.span('parse') as span:
+            df = cls.read(file_object, schema, **kwargs)
+            span.add(rows=len(df), bytes_in=len(file_object) if isinstance(file_object, bytes) else None)
+        with TSE_trace.span('transform') as span:
+            df = cls.transform(schema.select(df), **kwargs)
+            span.add(rows=len(df))
+        return df
+
+    @classmethod
+    def parse_chunks(cls, file_object, ano, nivel=None, chunksize=None, **kwargs):
+        """
+        Like parse, but reads the file in batches of chunksize rows,
+        yielding one transformed DataFrame per batch. The file object
+        can be an open stream, such as a member of a ZipFile.
+        """
+        schema = cls.schema(ano, nivel, file_object)
+        parse = TSE_trace.start('parse')
+        transform = TSE_trace.start('transform')
+        try:
+            with parse:
+                reader = cls.read(file_object, schema, chunksize=chunksize or cls.chunksize, **kwargs)
+            while True:
+                with parse:
+                    df = next(reader, None)
+                if df is None:
+                    break
+                parse.add(rows=len(df))
+                with transform:
+                    df = cls.transform(schema.select(df), **kwargs)
+                transform.add(rows=len(df))
+                yield df
+        finally:
+            parse.close()
+            transform.close()
+
+    @classmethod
+    def transform(cls, df, **kwargs):
+        """
+        Cleaning shared by the datasets: the codes of tabelas_depara, the
+        dates, the categories and, with to_numeric=True, the dtypes.
+        """
+        for col, depara in cls.tabelas_depara.items():
+            df[col] = cls.map_depara(df[col], depara)
+
+        cls.to_date(df, cls.dates, **kwargs)
+
+        cls.to_category(df, **kwargs)
+        if kwargs.get('to_numeric'):
+            cls.to_numeric(df, cls.dtypes, **kwargs)
+        return df
+
     @classmethod
     def get_dicionario(cls):
         return cls.tabelas_dicionario
@@ -168,6 +817,78 @@ class TSE_parse:
             dfs[key] = df
         return dfs
 
+    @staticmethod
+    def map_depara(series, depara, default=0):
+        """
+        Same as series.apply(lambda x: depara.get(slugify(str(x).strip()), default)),
+        but slugifies each distinct value only once.
+        """
+        codes, uniques = pandas.factorize(series, use_na_sentinel=False)
+        mapped = pandas.Index([depara.get(slugify(str(x).strip()), default) for x in uniques])
+        return pandas.Series(mapped.take(codes), index=series.index, name=series.name)
+
+    @staticmethod
+    def map_slugify(series):
+        """
+        Same as series.apply(slugify), slugifying each distinct value once.
+        """
+        codes, uniques = pandas.factorize(series, use_na_sentinel=False)
+        mapped = pandas.Index([slugify(str(x)) for x in uniques], dtype=object)
+        return pandas.Series(mapped.take(codes), index=series.index, name=series.name)
+
+    @classmethod
+    def to_numeric(cls, df, dtypes, **kwargs):
+        """
+        Converts the columns to the dtypes given by name, in bulk. Invalid
+        or missing integers become -1 and invalid, missing or negative
+        floats become NaN, as in parse_integer and parse_float; with
+        nullable=True, integers use the nullable dtypes (such as Int32)
+        and are left missing instead. Integers that do not fit in their
+        dtype keep the column as int64.
+        """
+        for col, dtype in dtypes.items():
+            if col not in df.columns:
+                continue
+            values = pandas.to_numeric(df[col], errors='coerce')
+            if dtype.startswith('int'):
+                values = values.where(values % 1 == 0)
+                limits = numpy.iinfo(dtype)
+                if ((values < limits.min) | (values > limits.max)).any():
+                    logging.warning(f'{col} does not fit in {dtype}; kept as int64')
+                    dtype = 'int64'
+                if kwargs.get('nullable'):
+                    df[col] = values.astype(dtype.capitalize())
+                else:
+                    df[col] = values.fillna(-1).astype(dtype)
+            else:
+                values = values.astype(dtype)
+                df[col] = values.where(values >= 0)
+        return df
+
+    @classmethod
+    def to_category(cls, df, **kwargs):
+        if kwargs.get('use_category') or kwargs.get('use_categories'):
+            for col in cls.categorical:
+                if col in df.columns:
+                    df[col] = df[col].astype('category')
+        return df
+
+    @classmethod
+    def to_date(cls, df, columns, **kwargs):
+        """
+        Parses dd/mm/yyyy dates in bulk. Invalid dates become None, as in
+        parse_data; with nullable=True, the columns are kept as datetime64
+        with NaT.
+        """
+        for col in columns:
+            if col in df.columns:
+                dates = pandas.to_datetime(df[col], format='%d/%m/%Y', errors='coerce')
+                if kwargs.get('nullable'):
+                    df[col] = dates
+                else:
+                    df[col] = dates.dt.date.astype(object).where(dates.notna(), None)
+        return df
+
     @staticmethod
     def parse_data(text):
         try:
@@ -191,6 +912,20 @@ class TSE_parse:
 
 class TSE_parse_demografia(TSE_parse):
 
+    dataset = 'demografia'
+    read_kwargs = dict()
+    text_dtype = None
+    categorical = ['UF', 'FaixaEtária']
+    dtypes = {
+        **TSE_parse.dtypes_codigos,
+        'Gênero': 'int8',
+        'EstadoCivil': 'int8',
+        'Escolaridade': 'int8',
+        'Quantidade': 'int32',
+        'QuantidadeDeficiência': 'int32',
+        'QuantidadeNomeSocial': 'int32',
+    }
+
     tabelas_dicionario = {
         'Gênero': {
             2: 'Masculino',
@@ -305,151 +1040,96 @@ class TSE_parse_demografia(TSE_parse):
         },
     }
     
+    colunas_municipios = {
+        None: [
+            ('SG_UF', 'UF'),
+            ('CD_MUNICIPIO', 'Município'),
+            ('NM_MUNICIPIO', 'Nome'),
+        ],
+        'zona': [
+            (1, 'UF'),
+            (3, 'Município'),
+            (2, 'Nome'),
+        ],
+        'secao': [
+            (3, 'UF'),
+            (4, 'Município'),
+            (5, 'Nome'),
+        ],
+    }
+
     @classmethod
     def list_municipios(cls, file_object, ano, nivel=None):
-        if (str(ano) in ['2018', 'ATUAL']):
-            columns = [
-                ('SG_UF', 'UF'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NM_MUNICIPIO', 'Nome'),
-            ]
-            header = 0
-        elif (str(ano) not in ['2018', 'ATUAL']) and (nivel == 'zona'):
-            columns = [
-                (1, 'UF'),
-                (3, 'Município'),
-                (2, 'Nome'),
-            ]
+        """
+        Returns the distinct (UF, Município, Nome) of a perfil file, with
+        a slugified "nome|uf" key. Files with a header are detected by
+        their first line; the others are read by position.
+        """
+        if isinstance(file_object, bytes):
+            file_object = io.BytesIO(file_object)
+        first_line = cls.first_line(file_object) or ''
+        if 'SG_UF' in [x.strip().strip('"') for x in first_line.split(';')]:
+            columns = cls.colunas_municipios[None]
             header = 0
-        elif (str(ano) not in ['2018', 'ATUAL']) and (nivel == 'secao'):
-            columns = [
-                (3, 'UF'),
-                (4, 'Município'),
-                (5, 'Nome'),
-            ]
-            header = 0
-        
+        else:
+            columns = cls.colunas_municipios[nivel]
+            header = None
+
         df = (
             pandas.read_csv(
-                io.BytesIO(file_object),
+                file_object,
                 sep=';',
                 header=header,
                 encoding='latin1',
+                usecols=[x[0] for x in columns],
+                dtype=str,
             )
             .rename(columns={x[0]: x[1] for x in columns})
             [[x[1] for x in columns]]
             .dropna()
             .drop_duplicates()
-            
         )
-        df['Município'] = df['Município'].apply(int)
+        df['Município'] = df['Município'].astype(int)
         df = df.sort_values(by=['Município']).reset_index(drop=True)
-        df['UF'] = df['UF'].apply(lambda x: str(x)[:2])
-        df['slugified'] = df.apply(lambda x: "{}|{}".format(slugify(x['Nome']), slugify(x['UF'])), axis=1)
+        df['UF'] = df['UF'].str[:2]
+        df['slugified'] = cls.map_slugify(df['Nome']) + '|' + cls.map_slugify(df['UF'])
         return df
 
     @classmethod
-    def parse(cls, file_object, ano, nivel, **kwargs):
-        
-        if (str(ano) in ['2018', 'ATUAL']) and (nivel == 'zona'):
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('SG_UF', 'UF'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NR_ZONA', 'Zona'),
-                ('DS_GENERO', 'Gênero'),
-                ('DS_ESTADO_CIVIL', 'EstadoCivil'),
-                ('DS_GRAU_ESCOLARIDADE', 'Escolaridade'),
-                ('DS_FAIXA_ETARIA', 'FaixaEtária'),
-                ('QT_ELEITORES_PERFIL', 'Quantidade'),
-                ('QT_ELEITORES_DEFICIENCIA', 'QuantidadeDeficiência'),
-                ('QT_ELEITORES_INC_NM_SOCIAL', 'QuantidadeNomeSocial'),
-            ]
-            columns_extra = []
-            header = 0
-        elif (str(ano) not in ['2018', 'ATUAL']) and (nivel == 'zona'):
-            columns = [
-                (0, 'Ano'),
-                (1, 'UF'),
-                (3, 'Município'),
-                (4, 'Zona'),
-                (5, 'Gênero'),
-                (7, 'Escolaridade'),
-                (6, 'FaixaEtária'),
-                (8, 'Quantidade'),
-            ]
-            columns_extra = [
-                'EstadoCivil',
-                'QuantidadeDeficiência',
-                'QuantidadeNomeSocial',
-            ]
-            header = None
-        elif (str(ano) in ['2018', 'ATUAL']) and (nivel == 'secao'):
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('SG_UF', 'UF'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NR_ZONA', 'Zona'),
-                ('NR_SECAO', 'Seção'),
-                ('DS_GENERO', 'Gênero'),
-                ('DS_ESTADO_CIVIL', 'EstadoCivil'),
-                ('DS_GRAU_ESCOLARIDADE', 'Escolaridade'),
-                ('DS_FAIXA_ETARIA', 'FaixaEtária'),
-                ('QT_ELEITORES_PERFIL', 'Quantidade'),
-                ('QT_ELEITORES_DEFICIENCIA', 'QuantidadeDeficiência'),
-                ('QT_ELEITORES_INC_NM_SOCIAL', 'QuantidadeNomeSocial'),
-            ]
-            columns_extra = []
-            header = 0
-        elif (str(ano) not in ['2018', 'ATUAL']) and (nivel == 'secao'):
-            columns = [
-                (2, 'Ano'),
-                (3, 'UF'),
-                (4, 'Município'),
-                (6, 'Zona'),
-                (7, 'Seção'),
-                (9, 'EstadoCivil'),
-                (15, 'Gênero'),
-                (13, 'Escolaridade'),
-                (11, 'FaixaEtária'),
-                (16, 'Quantidade'),
-            ]
-            columns_extra = [
-                'QuantidadeDeficiência',
-                'QuantidadeNomeSocial',
-            ]
-            header = None
-        
-        df = (
-            pandas.read_csv(
-                io.BytesIO(file_object),
-                sep=';',
-                header=header,
-                encoding='latin1',
-            )
-            .rename(columns={x[0]: x[1] for x in columns})
-            [[x[1] for x in columns]]
-            .reset_index(drop=True)
-        )
-        for col in columns_extra:
-            df[col] = None
-
-        for col, depara in cls.tabelas_depara.items():
-            df[col] = df[col].apply(lambda x: depara.get(slugify(str(x).strip()), 0))
-
-        df['Ano'] = df['Ano'].apply(lambda x: int(str(x)[:4]))
-        df['UF'] = df['UF'].apply(lambda x: str(x)[:2])
-
-        if kwargs.get('use_category'):
-            categorical = ['UF', 'FaixaEtária']
-            for col in categorical:
-                if col in df.columns:
-                    df[col] = df[col].astype('category')        
-        return df
+    def transform(cls, df, **kwargs):
+        df['Ano'] = df['Ano'].astype(str).str[:4].astype(int)
+        df['UF'] = df['UF'].astype(str).str[:2]
+        return super().transform(df, **kwargs)
     
 
 class TSE_parse_candidatos(TSE_parse):
 
+    dataset = 'candidatos'
+    categorical = [
+        'Eleição_nome',
+        'UF',
+        'UE',
+        'Partido_sigla',
+        'Partido_nome',
+        'Situação',
+        'Situação_detalhe',
+        'Agremiação',
+        'Nacionalidade',
+        'Nascimento_UF',
+        'Totalização',
+        'Reeleição',
+        'Declaração',
+    ]
+    dtypes = {
+        **TSE_parse.dtypes_codigos,
+        'Urna_número': 'int32',
+        'Partido_número': 'int16',
+        'Idade': 'int16',
+        'Nascimento_município': 'int32',
+        'Despesa': 'float64',
+    }
+    dates = ['Nascimento_data', 'Eleição_data']
+
     tabelas_dicionario = {
         'Gênero': {
             2: 'Masculino',
@@ -535,401 +1215,1339 @@ class TSE_parse_candidatos(TSE_parse):
             'indigena': 5,
         },
     }
-    
+
+
+class TSE_parse_votacao_candidato(TSE_parse):
+
+    dataset = 'votacao_candidato'
+    categorical = ['Eleição_nome', 'UF', 'UE',]
+    dtypes = {
+        **TSE_parse.dtypes_codigos,
+        'Votos': 'int32',
+        'Urna_número': 'int32',
+    }
+
+class TSE_parse_votacao_candidato_zona(TSE_parse_votacao_candidato):
+
+    dataset = 'votacao_candidato_zona'
+
+class TSE_parse_votacao_detalhe(TSE_parse):
+
+    dataset = 'votacao_detalhe'
+    categorical = ['Eleição_nome', 'UF', 'UE',]
+    dtypes = {
+        **TSE_parse.dtypes_codigos,
+        'Votos_aptos': 'int32',
+        'Votos_comparecimento': 'int32',
+        'Votos_abstenções': 'int32',
+        'Votos_nominais': 'int32',
+        'Votos_brancos': 'int32',
+        'Votos_nulos': 'int32',
+        'Votos_legenda': 'int32',
+        'Votos_pendentes': 'int32',
+    }
+
+
+class TSE_cache:
+    """
+    Cache of parsed DataFrames, stored as Arrow IPC (Feather) files and
+    memory-mapped when read back. Entries are keyed by the hash of the
+    source, the parser class, the schema version and the parser kwargs.
+    Reading an entry marks it as recently used; the least recently used
+    ones are removed when the folder grows over the budget (in bytes).
+    Set TSE_parse.cache to an instance to use it in every parse.
+    """
+
+    folder = os.path.expanduser('~/localdatalake/tse_cache')
+    budget = 10 * 2**30
+
+    def __init__(self, folder=None, budget=None):
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed for the cache')
+        self.folder = folder or self.folder
+        self.budget = budget or self.budget
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    @staticmethod
+    def fonte(content):
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def key(self, parser, fonte, ano, nivel=None, **kwargs):
+        return hashlib.sha1(json.dumps(
+            [fonte, parser.__name__, TSE_schemas.versao(), str(ano), nivel, kwargs],
+            sort_keys=True,
+            default=str,
+        ).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.arrow')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            source = pyarrow.memory_map(path)
+        except (FileNotFoundError, pyarrow.ArrowIOError):
+            return None
+        os.utime(path)
+        with source:
+            return pyarrow.ipc.open_file(source).read_all().to_pandas()
+
+    def put(self, key, df):
+        path = self.path(key)
+        temp_name = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as error:
+            logging.warning(f'Not cached: {error}')
+            return
+        with pyarrow.OSFile(temp_name, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_name, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.arrow'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(x[1] for x in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.budget:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def parse(self, parser, file_object, ano, nivel=None, fonte=None, **kwargs):
+        """
+        Same as parser.parse, reading the result from the cache if it is
+        there. Streams are read in full to be hashed, unless the hash of
+        the source is given.
+        """
+        if not isinstance(file_object, bytes) and fonte is None:
+            file_object = file_object.read()
+        key = self.key(parser, fonte or self.fonte(file_object), ano, nivel, **kwargs)
+        df = self.get(key)
+        if df is None:
+            df = parser.parse(file_object, ano, nivel=nivel, cache=False, **kwargs)
+            self.put(key, df)
+        return df
+
+    def parse_member(self, parser, zipped, name, ano, nivel=None, **kwargs):
+        """
+        Parses a member of a ZipFile, which is only decompressed if it is
+        not in the cache: its hash is taken from the CRC and size in the
+        ZIP directory.
+        """
+        info = zipped.getinfo(name)
+        fonte = '{:08x}-{}'.format(info.CRC, info.file_size)
+        key = self.key(parser, fonte, ano, nivel, **kwargs)
+        df = self.get(key)
+        if df is None:
+            df = parser.parse(zipped.read(name), ano, nivel=nivel, cache=False, **kwargs)
+            self.put(key, df)
+        return df
+
+
+class TSE_write:
+    """
+    Writes the parsed DataFrames of one output, batch by batch. Nothing
+    is visible at the final path until close is called. close calls done,
+    if given, once the final file exists, which may be after it returns.
+    """
+
+    _listings = {}
+    ## Whether close leaves the final file to a background thread
+    background = False
+
+    def __init__(self, save_full, parser=None):
+        self.save_full = save_full
+        self.parser = parser
+
     @classmethod
-    def parse(cls, file_object, ano, **kwargs):
-        
-        if int(ano) >= 2014:
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('NR_TURNO', 'Turno'),
-                ('DS_ELEICAO', 'Eleição_nome'),
-                ('DT_ELEICAO', 'Eleição_data'),
-                ('SG_UF', 'UF'),
-                ('SG_UE', 'UE'),
-                ('CD_CARGO', 'Cargo'),
-                ('SQ_CANDIDATO', 'id'),
-                ('NR_CPF_CANDIDATO', 'Documento_CPF'),
-                ('NM_CANDIDATO', 'Nome_completo'),
-                ('NM_URNA_CANDIDATO', 'Urna_nome'),
-                ('NM_SOCIAL_CANDIDATO', 'Nome_social'),
-                ('NR_CANDIDATO', 'Urna_número'),
-                ('DS_SITUACAO_CANDIDATURA', 'Situação'),
-                ('DS_DETALHE_SITUACAO_CAND', 'Situação_detalhe'),
-                ('TP_AGREMIACAO', 'Agremiação'),
-                ('NR_PARTIDO', 'Partido_número'),
-                ('SG_PARTIDO', 'Partido_sigla'),
-                ('NM_PARTIDO', 'Partido_nome'),
-                ('SQ_COLIGACAO', 'Coligação_código'),
-                ('DS_COMPOSICAO_COLIGACAO', 'Coligação_composição'),
-                ('DS_NACIONALIDADE', 'Nacionalidade'),
-                ('NR_IDADE_DATA_POSSE', 'Idade'),
-                ('SG_UF_NASCIMENTO', 'Nascimento_UF'),
-                ('CD_MUNICIPIO_NASCIMENTO', 'Nascimento_município'),
-                ('DT_NASCIMENTO', 'Nascimento_data'),
-                ('DS_OCUPACAO', 'Ocupação'),
-                ('NR_TITULO_ELEITORAL_CANDIDATO', 'Documento_título'),
-                ('DS_GENERO', 'Gênero'),
-                ('DS_GRAU_INSTRUCAO', 'Escolaridade'),
-                ('DS_ESTADO_CIVIL', 'EstadoCivil'),
-                ('DS_COR_RACA', 'Cor'),
-                ('NR_DESPESA_MAX_CAMPANHA', 'Despesa'),
-                ('DS_SIT_TOT_TURNO', 'Totalização'),
-                ('ST_REELEICAO', 'Reeleição'),
-                ('ST_DECLARAR_BENS', 'Declaração'),
-            ]
-            columns_extra = []
-            header = 0
-        elif ano <= 2012:
-            columns = [
-                (2, 'Ano'),
-                (3, 'Turno'),
-                (4, 'Eleição_nome'),
-                (5, 'UF'),
-                (6, 'UE'),
-                (8, 'Cargo'),
-                (11, 'id'),
-                (13, 'Documento_CPF'),
-                (10, 'Nome_completo'),
-                (14, 'Urna_nome'),
-                (12, 'Urna_número'),
-                (16, 'Situação'),
-                (17, 'Partido_número'),
-                (18, 'Partido_sigla'),
-                (19, 'Partido_nome'),
-                (20, 'Coligação_código'),
-                (22, 'Coligação_composição'),
-                (36, 'Nacionalidade'),
-                (28, 'Idade'),
-                (37, 'Nascimento_UF'),
-                (38, 'Nascimento_município'),
-                (26, 'Nascimento_data'),
-                (25, 'Ocupação'),
-                (27, 'Documento_título'),
-                (30, 'Gênero'),
-                (32, 'Escolaridade'),
-                (34, 'EstadoCivil'),
-                (40, 'Despesa'),
-                (42, 'Totalização'),
-            ]
-            columns_extra = [
-                'Eleição_data',
-                'Nome_social',
-                'Situação_detalhe',
-                'Agremiação',
-                'Cor',
-                'Reeleição',
-                'Declaração',
-            ]
-            header = None
+    def path(cls, main, ano=None, estado=None):
+        return os.path.join(main.folder, main.save_name.format(ano=ano, estado=estado))
 
-        df = (
-            pandas.read_csv(
-                io.BytesIO(file_object),
-                sep=';',
-                header=header,
-                encoding='latin1',
-                dtype='str',
-            )
-            .rename(columns={x[0]: x[1] for x in columns})
-            [[x[1] for x in columns]]
-            .reset_index(drop=True)
+    @classmethod
+    def name(cls, main, ano=None, estado=None):
+        """
+        Name of the output in messages.
+        """
+        return main.save_name.format(ano=ano, estado=estado)
+
+    @classmethod
+    def exists(cls, save_full, names=None):
+        """
+        Checks the disk, or the names of a listing of the folder if given.
+        """
+        if names is not None:
+            return os.path.basename(save_full) in names
+        return os.path.exists(save_full)
+
+    @classmethod
+    def listing(cls, folder):
+        """
+        Names in the folder, listed once per run (see forget).
+        """
+        if folder not in TSE_write._listings:
+            try:
+                TSE_write._listings[folder] = set(os.listdir(folder))
+            except OSError:
+                TSE_write._listings[folder] = set()
+        return TSE_write._listings[folder]
+
+    @classmethod
+    def planned(cls, save_full):
+        """
+        Same as exists, from the listing of its folder. Used to plan a
+        run, with one listing instead of one lookup per (ano, estado).
+        """
+        return cls.exists(save_full, names=cls.listing(os.path.dirname(save_full)))
+
+    @staticmethod
+    def listed(save_full):
+        """
+        Adds a file written in this process to the listing of its folder.
+        """
+        folder, name = os.path.split(save_full)
+        if folder in TSE_write._listings:
+            TSE_write._listings[folder].add(name)
+
+    @staticmethod
+    def forget():
+        TSE_write._listings.clear()
+
+    @staticmethod
+    def temp(name, suffix='tmp'):
+        """
+        Name of a temporary file next to name, unique to this process, so
+        that nodes sharing the folder never write the same one.
+        """
+        return '{}.{}.{}.{}'.format(name, socket.gethostname(), os.getpid(), suffix)
+
+    @classmethod
+    def wait(cls):
+        """
+        Waits for the work left in the background by close, if any.
+        """
+        pass
+
+    def abort(self):
+        """
+        Removes what was written, when the output cannot be completed.
+        """
+        pass
+
+
+class TSE_write_csv(TSE_write):
+
+    def __init__(self, save_full, parser=None):
+        super().__init__(save_full, parser)
+        self.temp_name = self.temp(save_full)
+        self.header = True
+
+    suffixes = ['', '.gz', '.zst']
+
+    @classmethod
+    def exists(cls, save_full, names=None):
+        return any(super(TSE_write_csv, cls).exists(save_full + x, names) for x in cls.suffixes)
+
+    def write(self, df):
+        df.to_csv(
+            self.temp_name,
+            mode='w' if self.header else 'a',
+            index=False,
+            header=self.header,
+            sep=';',
+            float_format='%.0f',
         )
-        for col in columns_extra:
-            df[col] = None
-            
-        for col, depara in cls.tabelas_depara.items():
-            df[col] = df[col].apply(lambda x: depara.get(slugify(str(x).strip()), 0)).astype(int)
-            
-        for col in df.select_dtypes(include=['object']).columns:
-            flter = df[col].apply(lambda x: x in ['#NULO#','#NE#'])
-            if sum(flter)>0:
-                df.loc[flter, col] = None
-        
-        for col in ['Nascimento_data', 'Eleição_data']:
-            df[col] = df[col].apply(cls.parse_data)
-        
-        if kwargs.get('use_category'):
-            categorical = [
-                'Eleição_nome',
-                'UF',
-                'UE',
-                'Partido_sigla',
-                'Partido_nome',
-                'Situação',
-                'Situação_detalhe',
-                'Agremiação',
-                'Nacionalidade',
-                'Nascimento_UF',
-                'Totalização',
-                'Reeleição',
-                'Declaração',
-            ]
-            for col in categorical:
-                if col in df.columns:
-                    df[col] = df[col].astype('category')
-    
-        if kwargs.get('to_numeric'):
-            numeric_integer = ['Ano', 'Turno', 'Cargo', 'Urna_número', 'Partido_número', 'Idade', 'Nascimento_município']
-            numeric_float = ['Despesa']
-            for col in numeric_integer:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_integer(x)).astype(int)
-            for col in numeric_float:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_float(x)).astype(float)
-                    df.loc[df[col]<0, col] = None
-    
-        return df
+        self.header = False
+
+    def close(self, done=None):
+        if not self.header:
+            os.replace(self.temp_name, self.save_full)
+            self.listed(self.save_full)
+            if done:
+                done()
+
+    def abort(self):
+        if os.path.exists(self.temp_name):
+            os.remove(self.temp_name)
+
+
+class TSE_write_compressed(TSE_write_csv):
+    """
+    Writes the CSV as TSE_write_csv and compresses it on a background
+    thread once it is complete, so that the next file is parsed in the
+    meantime. The uncompressed file is removed after compression.
+    """
+
+    suffix = None
+    background = True
+    threads = os.cpu_count() or 1
+    workers = 2
+    _pool = None
+    _pending = []
+    _lock = threading.Lock()
 
-        
+    @classmethod
+    def path(cls, main, ano=None, estado=None):
+        return super().path(main, ano=ano, estado=estado) + cls.suffix
 
-class TSE_parse_votacao_candidato(TSE_parse):
+    @classmethod
+    def exists(cls, save_full, names=None):
+        return super().exists(save_full[:-len(cls.suffix)], names)
 
     @classmethod
-    def parse(cls, file_object, ano, nivel, **kwargs):
-        
-        if int(ano) >= 2018:
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('NR_TURNO', 'Turno'),
-                ('DS_ELEICAO', 'Eleição_nome'),
-                ('SG_UF', 'UF'),
-                ('SG_UE', 'UE'),
-                ('CD_CARGO', 'Cargo'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NR_ZONA', 'Zona'),
-                ('NR_VOTAVEL', 'Urna_número'),
-                ('QT_VOTOS', 'Votos'),
-            ]
-            if nivel == 'secao':
-                columns += [('NR_SECAO', 'Seção'),]
-            columns_extra = []
-            header = 0
-        elif ano <= 2016:
-            shift_secao = 1 if nivel == 'secao' else 0
-            columns = [
-                (2, 'Ano'),
-                (3, 'Turno'),
-                (4, 'Eleição_nome'),
-                (5, 'UF'),
-                (6, 'UE'),
-                (10+shift_secao, 'Cargo'),
-                (7, 'Município'),
-                (9, 'Zona'),
-                (12+shift_secao, 'Urna_número'),
-                (13+shift_secao, 'Votos'),
-            ]
-            if nivel == 'secao':
-                columns += [(10, 'Seção'),]
-            columns_extra = []
-            header = None
+    def pool(cls):
+        with cls._lock:
+            if cls._pool is None:
+                cls._pool = ThreadPoolExecutor(max_workers=cls.workers)
+            return cls._pool
+
+    def close(self, done=None):
+        if not self.header:
+            future = self.pool().submit(self.compress, self.temp_name, self.save_full, TSE_trace.current(), done)
+            with self._lock:
+                self._pending.append(future)
 
-        df = (
-            pandas.read_csv(
-                io.BytesIO(file_object),
-                sep=';',
-                header=header,
-                encoding='latin1',
-                dtype='str',
-            )
-            [[x[0] for x in columns]]
-            .rename(columns={x[0]: x[1] for x in columns})
-            .reset_index(drop=True)
+    @classmethod
+    def compress(cls, temp_name, save_full, labels, done=None):
+        part_name = cls.temp(save_full, 'part')
+        with TSE_trace.labels(**labels), TSE_trace.span('compress', arquivo=os.path.basename(save_full)) as span:
+            with open(temp_name, 'rb') as flread, cls.open(part_name) as flsave:
+                shutil.copyfileobj(flread, flsave, 2**20)
+            span.add(bytes_in=os.path.getsize(temp_name), bytes_out=os.path.getsize(part_name))
+        os.replace(part_name, save_full)
+        os.remove(temp_name)
+        cls.listed(save_full)
+        if done:
+            done()
+
+    @classmethod
+    def wait(cls):
+        with cls._lock:
+            pending, cls._pending[:] = list(cls._pending), []
+        for future in pending:
+            future.result()
+
+
+class TSE_write_gzip(TSE_write_compressed):
+    """
+    Compresses with pgzip, on several threads, if it is installed, and
+    with the gzip module otherwise.
+    """
+
+    suffix = '.gz'
+
+    @classmethod
+    def open(cls, name):
+        if pgzip is not None:
+            return pgzip.open(name, 'wb', thread=cls.threads)
+        return gzip.open(name, 'wb')
+
+
+class TSE_write_zstd(TSE_write_compressed):
+
+    suffix = '.zst'
+
+    def __init__(self, save_full, parser=None):
+        if zstandard is None:
+            raise ImportError('zstandard is needed for the csv.zst output')
+        super().__init__(save_full, parser)
+
+    @classmethod
+    def open(cls, name):
+        return zstandard.open(name, 'wb', cctx=zstandard.ZstdCompressor(threads=cls.threads))
+
+
+class TSE_write_parquet(TSE_write):
+    """
+    Writes a hive-style partitioned Parquet dataset, such as
+    VotoSecao/ano=2018/UF=SP/part-00000.parquet, with one file per batch.
+    Columns that are also partition keys are restored from the path on
+    reading, so they are not stored in the files. Strings are stored as
+    dictionary-encoded columns. The columns with a dtype or a date in the
+    parser are always stored as int64, float64 or date32, whatever their
+    dtype in the batch (text, a narrow dtype, or no value at all, as in
+    the columns a layout lacks), so that every year of a dataset has the
+    same schema.
+    """
+
+    folder = os.path.expanduser('~/localdatalake/tse_refined/parquet')
+
+    def __init__(self, save_full, parser=None):
+        super().__init__(save_full, parser)
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed for the parquet output')
+        importlib.import_module('pyarrow.parquet')
+        folder, partition = os.path.split(save_full)
+        self.temp_name = self.temp(os.path.join(folder, '.' + partition))
+        self.partition_keys = [
+            x.split('=')[0] for x in os.path.relpath(save_full, self.folder).split(os.sep) if '=' in x
+        ]
+        self.parts = 0
+        if os.path.isdir(self.temp_name):
+            shutil.rmtree(self.temp_name)
+        os.makedirs(self.temp_name)
+
+    @classmethod
+    def path(cls, main, ano=None, estado=None):
+        dataset = main.save_name.split('_')[0]
+        partitions = [f'ano={ano}']
+        if '{estado}' in main.save_name:
+            partitions.append(f'UF={estado}')
+        return os.path.join(cls.folder, dataset, *partitions)
+
+    @classmethod
+    def name(cls, main, ano=None, estado=None):
+        return os.path.relpath(cls.path(main, ano=ano, estado=estado), cls.folder)
+
+    def dtypes(self):
+        """
+        The numeric dtypes of the parser, widened to 64 bits: integers
+        that do not fit in the narrow ones are kept as int64.
+        """
+        if self.parser is None:
+            return {}
+        return {
+            col: 'int64' if numpy.dtype(dtype).kind in 'iu' else 'float64'
+            for col, dtype in self.parser.dtypes.items()
+        }
+
+    def field_type(self, field):
+        """
+        Type of a column: a date or the type of its values, with strings
+        for the columns without any value.
+        """
+        if self.parser is not None and field.name in self.parser.dates:
+            return pyarrow.date32()
+        if pyarrow.types.is_null(field.type):
+            return pyarrow.string()
+        return field.type
+
+    def schema(self, table):
+        fields = []
+        for field in table.schema:
+            field = field.with_type(self.field_type(field))
+            if pyarrow.types.is_string(field.type) or pyarrow.types.is_large_string(field.type):
+                field = field.with_type(pyarrow.dictionary(pyarrow.int32(), field.type))
+            fields.append(field)
+        return pyarrow.schema(fields)
+
+    def write(self, df):
+        df = df.drop(columns=[x for x in self.partition_keys if x in df.columns])
+        TSE_parse.to_numeric(df, self.dtypes(), nullable=True)
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        table = table.cast(self.schema(table))
+        pyarrow.parquet.write_table(
+            table,
+            os.path.join(self.temp_name, 'part-{:05d}.parquet'.format(self.parts)),
         )
-        for col in columns_extra:
-            df[col] = None
-                        
-        for col in df.select_dtypes(include=['object']).columns:
-            flter = df[col].apply(lambda x: x in ['#NULO#','#NE#'])
-            if sum(flter)>0:
-                df.loc[flter, col] = None
-
-        if kwargs.get('use_categories'):        
-            categorical = ['Eleição_nome', 'UF', 'UE',]
-            for col in categorical:
-                if col in df.columns:
-                    df[col] = df[col].astype('category')
-    
-        if kwargs.get('to_numeric'):
-            numeric_integer = ['Ano', 'Turno', 'Cargo', 'Município', 'Zona', 'Seção', 'Votos', 'Urna_número']
-            numeric_float = []
-            for col in numeric_integer:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_integer(x)).astype(int)
-            for col in numeric_float:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_float(x)).astype(float)
-                    df.loc[df[col]<0, col] = None
-    
-        return df
+        self.parts += 1
 
-class TSE_parse_votacao_candidato_zona(TSE_parse):
-
-    @classmethod
-    def parse(cls, file_object, ano, **kwargs):
-        
-        if int(ano) >= 2016:
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('NR_TURNO', 'Turno'),
-                ('DS_ELEICAO', 'Eleição_nome'),
-                ('SG_UF', 'UF'),
-                ('SG_UE', 'UE'),
-                ('CD_CARGO', 'Cargo'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NR_ZONA', 'Zona'),
-                ('NR_CANDIDATO', 'Urna_número'),
-                ('QT_VOTOS_NOMINAIS', 'Votos'),
-            ]
-            columns_extra = []
-            header = 0
-        elif ano <= 2014:
-            columns = [
-                (2, 'Ano'),
-                (3, 'Turno'),
-                (4, 'Eleição_nome'),
-                (5, 'UF'),
-                (6, 'UE'),
-                (10, 'Cargo'),
-                (7, 'Município'),
-                (9, 'Zona'),
-                (11, 'Urna_número'),
-                (28, 'Votos'),
-            ]
-            columns_extra = []
-            header = None
+    def close(self, done=None):
+        if os.path.isdir(self.save_full):
+            shutil.rmtree(self.save_full)
+        os.replace(self.temp_name, self.save_full)
+        self.listed(self.save_full)
+        if done:
+            done()
 
-        df = (
-            pandas.read_csv(
-                io.BytesIO(file_object),
-                sep=';',
-                header=header,
-                encoding='latin1',
-                dtype='str',
-            )
-            [[x[0] for x in columns]]
-            .rename(columns={x[0]: x[1] for x in columns})
-            .reset_index(drop=True)
+    def abort(self):
+        shutil.rmtree(self.temp_name, ignore_errors=True)
+
+
+class TSE_build:
+    """
+    Records what each output was built from: the hash of the source member
+    (its CRC and size, read from the ZIP directory), the parser class, the
+    schema version and layout, and the parser kwargs. The record is kept
+    in a hidden file next to the output.
+    """
+
+    @staticmethod
+    def record_name(save_full):
+        folder, name = os.path.split(save_full)
+        return os.path.join(folder, '.' + name + '.build.json')
+
+    @classmethod
+    def record(cls, main, zipped, name, ano=None, **kwargs):
+        info = zipped.getinfo(name)
+        with zipped.open(name) as flread:
+            schema = main.class_parser.schema(ano, main.parser_kwargs.get('nivel'), flread)
+        return dict(
+            fonte='{:08x}-{}'.format(info.CRC, info.file_size),
+            membro=name,
+            parser=main.class_parser.__name__,
+            schema='{}:{}'.format(schema.versao, schema.nome),
+            kwargs=dict(main.parser_kwargs, engine=kwargs.get('engine')),
         )
-        for col in columns_extra:
-            df[col] = None
-                        
-        for col in df.select_dtypes(include=['object']).columns:
-            flter = df[col].apply(lambda x: x in ['#NULO#','#NE#'])
-            if sum(flter)>0:
-                df.loc[flter, col] = None
-
-        if kwargs.get('use_categories'):        
-            categorical = ['Eleição_nome', 'UF', 'UE',]
-            for col in categorical:
-                if col in df.columns:
-                    df[col] = df[col].astype('category')
-    
-        if kwargs.get('to_numeric'):
-            numeric_integer = ['Ano', 'Turno', 'Cargo', 'Município', 'Zona', 'Seção', 'Votos', 'Urna_número']
-            numeric_float = []
-            for col in numeric_integer:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_integer(x)).astype(int)
-            for col in numeric_float:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_float(x)).astype(float)
-                    df.loc[df[col]<0, col] = None
-    
+
+    @classmethod
+    def read(cls, save_full):
+        try:
+            with open(cls.record_name(save_full), 'r') as flread:
+                return json.load(flread)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def write(cls, save_full, record):
+        record_name = cls.record_name(save_full)
+        with open(record_name + '.tmp', 'w') as flsave:
+            json.dump(record, flsave, indent=1, sort_keys=True, ensure_ascii=False)
+        os.replace(record_name + '.tmp', record_name)
+
+    @classmethod
+    def writer(cls, save_full, record):
+        """
+        Function that writes the record, to be called once the output is
+        complete, or None if there is no record.
+        """
+        if record:
+            return lambda: cls.write(save_full, record)
+
+    @classmethod
+    def is_current(cls, save_full, record):
+        return cls.read(save_full) == json.loads(json.dumps(record))
+
+
+class TSE_municipios:
+    """
+    Dimension of the municipalities of one election: the TSE code of
+    each one, with its UF, name and slug ("nome|uf"). It is built once
+    from the perfil file of the year (see list_municipios) and stored as
+    sorted numpy arrays, in a file named after the year and the version
+    of the index. Codes are looked up by binary search and slugs through
+    a dict; names that do not match exactly can be matched fuzzily
+    within the same UF.
+    """
+
+    folder = os.path.expanduser('~/localdatalake/tse_refined/municipios')
+    versao = 1
+    cutoff = 0.85
+
+    def __init__(self, codigo, uf, nome, slug, ano=None):
+        order = numpy.argsort(codigo, kind='stable')
+        self.codigo = numpy.asarray(codigo, dtype='int32')[order]
+        self.uf = numpy.asarray(uf, dtype=str)[order]
+        self.nome = numpy.asarray(nome, dtype=str)[order]
+        self.slug = numpy.asarray(slug, dtype=str)[order]
+        self.ano = ano
+        self.por_slug = dict(zip(self.slug.tolist(), self.codigo.tolist()))
+        self._por_uf = None
+
+    def __len__(self):
+        return len(self.codigo)
+
+    @classmethod
+    def path(cls, ano):
+        return os.path.join(cls.folder, 'municipios_{}.v{}.npz'.format(ano, cls.versao))
+
+    @classmethod
+    def from_frame(cls, df, ano=None):
+        df = df.drop_duplicates(subset=['Município'])
+        return cls(df['Município'], df['UF'], df['Nome'], df['slugified'], ano=ano)
+
+    @classmethod
+    def build(cls, ano, **kwargs):
+        """
+        Builds the index from the perfil file of the year, downloading it
+        if needed.
+        """
+        download = TSE_download_demografia_zona.download(ano=ano, stream=kwargs.get('stream'))
+        if not download:
+            raise IOError(f'No perfil file for {ano}')
+        frames = []
+        for name in download.namelist():
+            if name.endswith('txt') or name.endswith('csv'):
+                with download.open(name) as flread:
+                    frames.append(TSE_parse_demografia.list_municipios(flread.read(), ano, nivel='zona'))
+        return cls.from_frame(pandas.concat(frames), ano=ano)
+
+    @classmethod
+    def load(cls, ano, force=False, **kwargs):
+        """
+        Reads the index of the year, building and saving it the first time.
+        """
+        path = cls.path(ano)
+        if os.path.exists(path) and not force:
+            with numpy.load(path, allow_pickle=False) as arrays:
+                if int(arrays['versao']) == cls.versao:
+                    return cls(arrays['codigo'], arrays['uf'], arrays['nome'], arrays['slug'], ano=ano)
+        municipios = cls.build(ano, **kwargs)
+        municipios.save(path)
+        return municipios
+
+    @classmethod
+    def main_loop(cls, anos=None, **kwargs):
+        """
+        Loads the index of each year, reporting the years that fail.
+        """
+        for ano in (anos or Main_demografia_zona.anos):
+            try:
+                municipios = cls.load(ano, **kwargs)
+            except (IOError, ValueError, requests.RequestException) as error:
+                print('[{}] PROBLEM with municipios: {} ({})'.format(get_time_now(), ano, error))
+                continue
+            print('[{}] Municipios: {} ({})'.format(get_time_now(), ano, len(municipios)))
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp_name = path + '.tmp.npz'
+        numpy.savez_compressed(
+            temp_name,
+            versao=self.versao,
+            codigo=self.codigo,
+            uf=self.uf,
+            nome=self.nome,
+            slug=self.slug,
+        )
+        os.replace(temp_name, path)
+
+    def frame(self):
+        return pandas.DataFrame({
+            'Município': self.codigo,
+            'UF': self.uf,
+            'Nome': self.nome,
+            'slugified': self.slug,
+        })
+
+    def get(self, codigos):
+        """
+        Returns the UF, Nome and slug of each code, in the same order;
+        unknown codes get None.
+        """
+        codigos = pandas.to_numeric(pandas.Series(codigos), errors='coerce').to_numpy(dtype=float)
+        position = numpy.searchsorted(self.codigo, codigos).clip(0, len(self) - 1)
+        found = self.codigo[position] == codigos
+        df = self.frame().iloc[position].reset_index(drop=True)
+        for col in ['UF', 'Nome', 'slugified']:
+            df[col] = df[col].astype(object).where(found, None)
+        df['Município'] = numpy.where(found, df['Município'], -1)
         return df
 
-class TSE_parse_votacao_detalhe(TSE_parse):
+    def por_uf(self):
+        if self._por_uf is None:
+            self._por_uf = {}
+            for slug in self.slug.tolist():
+                nome, uf = slug.rsplit('|', 1)
+                self._por_uf.setdefault(uf, []).append(nome)
+        return self._por_uf
+
+    def match(self, nome, uf, fuzzy=True):
+        """
+        Returns the code of a municipality by its name and UF, or -1.
+        """
+        nome, uf = slugify(str(nome)), slugify(str(uf))
+        codigo = self.por_slug.get('{}|{}'.format(nome, uf))
+        if codigo is None and fuzzy:
+            close = difflib.get_close_matches(nome, self.por_uf().get(uf, []), n=1, cutoff=self.cutoff)
+            if close:
+                codigo = self.por_slug['{}|{}'.format(close[0], uf)]
+        return -1 if codigo is None else codigo
+
+    def codigos(self, nomes, ufs, fuzzy=True):
+        """
+        Same as match, for columns of names and UFs, matching each
+        distinct pair only once.
+        """
+        pairs = pandas.DataFrame({'nome': pandas.Series(nomes).to_numpy(), 'uf': pandas.Series(ufs).to_numpy()})
+        uniques = pairs.drop_duplicates()
+        uniques['Município'] = [self.match(x, y, fuzzy=fuzzy) for x, y in zip(uniques['nome'], uniques['uf'])]
+        return pairs.merge(uniques, on=['nome', 'uf'], how='left')['Município'].to_numpy()
+
+
+WRITERS = {
+    'csv': TSE_write_csv,
+    'csv.gz': TSE_write_gzip,
+    'csv.zst': TSE_write_zstd,
+    'parquet': TSE_write_parquet,
+}
+
+
+class TSE_span:
+    """
+    Wall time, CPU time (of the running thread), bytes in and out, rows
+    and peak RSS of one stage. A span can be entered several times, for
+    example once per batch of rows, and is emitted once, by close.
+    """
+
+    def __init__(self, stage, **labels):
+        self.record = dict(
+            stage=stage,
+            **labels,
+            wall=0.,
+            cpu=0.,
+            bytes_in=None,
+            bytes_out=None,
+            rows=None,
+        )
+        self.closed = False
+
+    def __enter__(self):
+        TSE_trace.active().append(self)
+        self.start = (time.perf_counter(), time.thread_time())
+        return self
+
+    def __exit__(self, *args):
+        self.elapse(time.perf_counter() - self.start[0], time.thread_time() - self.start[1])
+        TSE_trace.active().remove(self)
+        if args[0] is not None:
+            self.record['error'] = args[0].__name__
+
+    def elapse(self, wall, cpu):
+        self.record['wall'] += wall
+        self.record['cpu'] += cpu
+
+    def exclude(self, wall, cpu):
+        """
+        Discounts time spent in another span, such as decompressing
+        while reading.
+        """
+        self.elapse(-wall, -cpu)
+
+    def add(self, rows=None, bytes_in=None, bytes_out=None):
+        for key, value in [('rows', rows), ('bytes_in', bytes_in), ('bytes_out', bytes_out)]:
+            if value is not None:
+                self.record[key] = (self.record[key] or 0) + value
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if resource is not None:
+            ## ru_maxrss is in kilobytes on Linux
+            self.record['rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        TSE_trace.emit(self.record)
+
+
+class TSE_reader(io.RawIOBase):
+    """
+    Wraps a stream, such as a member of a ZipFile, counting the time spent
+    reading it in a decompress span instead of the spans reading from it.
+    """
+
+    def __init__(self, raw, span):
+        self.raw = raw
+        self.span = span
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.raw.seekable()
+
+    def seek(self, *args):
+        return self.raw.seek(*args)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def readinto(self, buffer):
+        start = (time.perf_counter(), time.thread_time())
+        size = self.raw.readinto(buffer)
+        wall, cpu = time.perf_counter() - start[0], time.thread_time() - start[1]
+        self.span.elapse(wall, cpu)
+        self.span.add(bytes_out=size)
+        for span in TSE_trace.active():
+            span.exclude(wall, cpu)
+        return size
+
+
+class TSE_trace:
+    """
+    Collects the spans of a run. Each span is labelled with the dataset,
+    ano and UF being processed, taken from the innermost labels block of
+    the running thread. With an output file, spans are also appended to
+    it as JSON lines, including those of the worker processes.
+    """
+
+    output = None
+    run = None
+    spans = []
+    progress = ['download', 'write']
+    _local = threading.local()
+    _lock = threading.Lock()
 
     @classmethod
-    def parse(cls, file_object, ano, nivel, **kwargs):
-        
-        if int(ano) >= 2018:
-            columns = [
-                ('ANO_ELEICAO', 'Ano'),
-                ('NR_TURNO', 'Turno'),
-                ('DS_ELEICAO', 'Eleição_nome'),
-                ('SG_UF', 'UF'),
-                ('SG_UE', 'UE'),
-                ('CD_CARGO', 'Cargo'),
-                ('CD_MUNICIPIO', 'Município'),
-                ('NR_ZONA', 'Zona'),
-                ('QT_APTOS', 'Votos_aptos'),
-                ('QT_COMPARECIMENTO', 'Votos_comparecimento'),
-                ('QT_ABSTENCOES', 'Votos_abstenções'),
-                ('QT_VOTOS_NOMINAIS', 'Votos_nominais'),
-                ('QT_VOTOS_BRANCOS', 'Votos_brancos'),
-                ('QT_VOTOS_NULOS', 'Votos_nulos'),
-                ('QT_VOTOS_LEGENDA', 'Votos_legenda'),
-                ('QT_VOTOS_PENDENTES', 'Votos_pendentes'),
-            ]
-            if nivel == 'secao':
-                columns += [('NR_SECAO', 'Seção'),]
-            columns_extra = []
-            header = 0
-        elif ano <= 2016:
-            shift_secao = 1 if nivel == 'secao' else 0
-            columns = [
-                (2, 'Ano'),
-                (3, 'Turno'),
-                (4, 'Eleição_nome'),
-                (5, 'UF'),
-                (6, 'UE'),
-                (10+shift_secao, 'Cargo'),
-                (7, 'Município'),
-                (9, 'Zona'),
-                (12+shift_secao, 'Votos_aptos'),
-                (13+shift_secao, 'Votos_comparecimento'),
-                (14+shift_secao, 'Votos_abstenções'),
-                (15+shift_secao, 'Votos_nominais'),
-                (16+shift_secao, 'Votos_brancos'),
-                (17+shift_secao, 'Votos_nulos'),
-                (18+shift_secao, 'Votos_legenda'),
-                (19+shift_secao, 'Votos_pendentes'),
-            ]
-            if nivel == 'secao':
-                columns += [(10, 'Seção'),]
-            columns_extra = []
-            header = None
+    def configure(cls, output=None, run=None):
+        cls.output = output
+        cls.run = run or '{}-{}'.format(datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
 
-        df = (
-            pandas.read_csv(
-                io.BytesIO(file_object),
-                sep=';',
-                header=header,
-                encoding='latin1',
-                dtype='str',
+    @classmethod
+    def active(cls):
+        if not hasattr(cls._local, 'active'):
+            cls._local.active = []
+        return cls._local.active
+
+    @classmethod
+    def current(cls):
+        return dict(getattr(cls._local, 'labels', {}))
+
+    @classmethod
+    @contextlib.contextmanager
+    def labels(cls, **labels):
+        previous = getattr(cls._local, 'labels', {})
+        cls._local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            cls._local.labels = previous
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, stage, **labels):
+        span = TSE_span(stage, **dict(getattr(cls._local, 'labels', {}), **labels))
+        try:
+            with span:
+                yield span
+        finally:
+            span.close()
+
+    @classmethod
+    def start(cls, stage, **labels):
+        """
+        Returns a span to be entered once per batch and closed at the end.
+        """
+        return TSE_span(stage, **dict(getattr(cls._local, 'labels', {}), **labels))
+
+    @classmethod
+    def emit(cls, record):
+        record = dict(record, run=cls.run, pid=os.getpid(), data=get_time_now())
+        with cls._lock:
+            cls.spans.append(record)
+            if cls.output:
+                with open(cls.output, 'a') as flsave:
+                    flsave.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        if record['stage'] in cls.progress:
+            print('[{}] {} {} {} {}: {:.1f} s{}{}'.format(
+                record['data'],
+                record['stage'],
+                record.get('dataset'),
+                record.get('ano'),
+                record.get('UF') or '',
+                record['wall'],
+                ', {} rows'.format(record['rows']) if record['rows'] is not None else '',
+                ', {:.1f} MB'.format(record['bytes_out'] / 2**20) if record['bytes_out'] else '',
+            ))
+
+    @staticmethod
+    def size(path):
+        if os.path.isdir(path):
+            return sum(
+                os.path.getsize(os.path.join(folder, x))
+                for folder, _, files in os.walk(path) for x in files
             )
-            [[x[0] for x in columns]]
-            .rename(columns={x[0]: x[1] for x in columns})
-            .reset_index(drop=True)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    @classmethod
+    def read(cls):
+        """
+        Returns the spans of the current run, from the output file if
+        there is one (so that worker processes are included).
+        """
+        if not cls.output:
+            return pandas.DataFrame(cls.spans)
+        with open(cls.output, 'r') as flread:
+            records = [json.loads(line) for line in flread if line.strip()]
+        return pandas.DataFrame([x for x in records if x.get('run') == cls.run])
+
+    @classmethod
+    def summary(cls, top=20):
+        df = cls.read()
+        if df.empty:
+            return ''
+        for col in ['dataset', 'ano', 'UF', 'rss_mb']:
+            if col not in df.columns:
+                df[col] = None
+        stages = df.groupby('stage').agg(
+            wall=('wall', 'sum'),
+            cpu=('cpu', 'sum'),
+            bytes_in=('bytes_in', 'sum'),
+            bytes_out=('bytes_out', 'sum'),
+            rows=('rows', 'sum'),
+            rss_mb=('rss_mb', 'max'),
+        ).sort_values('wall', ascending=False)
+        keys = df[['dataset', 'ano', 'UF']].astype(str)
+        items = df.assign(**keys).pivot_table(
+            index=['dataset', 'ano', 'UF'],
+            columns='stage',
+            values='wall',
+            aggfunc='sum',
+            fill_value=0,
         )
-        for col in columns_extra:
-            df[col] = None
-                        
-        for col in df.select_dtypes(include=['object']).columns:
-            flter = df[col].apply(lambda x: x in ['#NULO#','#NE#'])
-            if sum(flter)>0:
-                df.loc[flter, col] = None
-
-        if kwargs.get('use_categories'):        
-            categorical = ['Eleição_nome', 'UF', 'UE',]
-            for col in categorical:
-                if col in df.columns:
-                    df[col] = df[col].astype('category')
-    
-        if kwargs.get('to_numeric'):
-            numeric_integer = ['Ano', 'Turno', 'Cargo', 'Município', 'Zona', 'Seção', ] + [x for x in df.columns if x.startswith('Votos')]
-            numeric_float = []
-            for col in numeric_integer:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_integer(x)).astype(int)
-            for col in numeric_float:
-                if col in df.columns:
-                    df[col] = df[col].apply(lambda x: cls.parse_float(x)).astype(float)
-                    df.loc[df[col]<0, col] = None
-    
-        return df
+        items['total'] = items.sum(axis=1)
+        items = items.sort_values('total', ascending=False).head(top)
+        with pandas.option_context('display.width', 200, 'display.max_columns', None):
+            return '{}\n\n{}'.format(
+                stages.to_string(float_format='{:.1f}'.format),
+                items.to_string(float_format='{:.1f}'.format),
+            )
+
+
+class TSE_sink:
+    """
+    Destination of the parsed DataFrames of one output: the writer and,
+    if one was chosen, the warehouse, timed as a write span.
+    """
+
+    def __init__(self, main, save_full, save_name=None, labels=None, **kwargs):
+        self.save_full = save_full
+        self.writer = main.writer(**kwargs)(save_full, main.class_parser)
+        self.warehouse = None
+        if kwargs.get('warehouse'):
+            self.warehouse = tse_warehouse.WAREHOUSES[kwargs.get('warehouse')]()
+            self.warehouse.begin(
+                main.save_name.split('_')[0],
+                save_name or os.path.basename(save_full),
+                modo=kwargs.get('warehouse_modo') or 'replace',
+            )
+        self.span = TSE_trace.start('write', arquivo=save_name or os.path.basename(save_full), **(labels or {}))
+
+    def write(self, df):
+        with self.span:
+            self.writer.write(df)
+            if self.warehouse:
+                self.warehouse.add(df)
+        self.span.add(rows=len(df))
+
+    def close(self, done=None):
+        with self.span:
+            self.writer.close(done)
+            if self.warehouse:
+                self.warehouse.end()
+                self.warehouse.close()
+        if not self.writer.background:
+            ## Compressed files are measured by their compress span
+            self.span.add(bytes_out=TSE_trace.size(self.save_full))
+        self.span.close()
+
+    def abort(self):
+        with self.span:
+            self.writer.abort()
+            if self.warehouse:
+                self.warehouse.rollback()
+                self.warehouse.close()
+        self.span.close()
+
+
+class TSE_pipeline:
+    """
+    Runs a Main subclass as four stages connected by bounded queues:
+    download, decompress, parse and write. Each stage runs on its own
+    threads, so the network, the CPU and the disk are busy at the same
+    time, and a full queue blocks the stage before it. Members are passed
+    on as open streams and parsed in batches of chunksize rows, so the
+    memory is bounded by a few batches in flight; with an engine, which
+    cannot read in batches, each parse worker holds a whole member.
+    """
+
+    done = object()
+    end = object()
+
+    def __init__(self, main, queue_size=4, **kwargs):
+        self.main = main
+        self.kwargs = kwargs
+        if not kwargs.get('chunksize') and not kwargs.get('engine'):
+            self.kwargs = dict(kwargs, chunksize=main.class_parser.chunksize)
+        self.stages = [
+            (self.download, kwargs.get('download_concurrency') or 1),
+            (self.decompress, 1),
+            (self.parse, kwargs.get('workers') or 1),
+            ## A single writer keeps the batches of each output in order
+            (self.write, 1),
+        ]
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(self.stages) + 1)]
+
+    def download(self, job):
+        ano, estado = job
+        main = self.main
+        if not main.needs_update(ano=ano, estado=estado, **self.kwargs):
+            name = main.writer(**self.kwargs).name(main, ano=ano, estado='*' if main.is_national(estado) else estado)
+            print('[{}] Found: {}'.format(get_time_now(), name))
+            return
+        with main.labels(ano=ano, estado=estado):
+            zipped = main.class_downloader.download(
+                ano=ano,
+                estado=estado,
+                stream=True,
+                revalidate=self.kwargs.get('revalidate') or self.kwargs.get('incremental'),
+            )
+        if zipped:
+            yield ano, zipped
+
+    def decompress(self, item):
+        ano, zipped = item
+        for name, save_name, save_full, record in self.main.list_members(zipped, **self.kwargs):
+            match = self.main.regular_expression.match(os.path.basename(name))
+            with self.main.labels(ano=match.group(1), estado=match.group(2)):
+                output = dict(save_full=save_full, save_name=save_name, record=record, labels=TSE_trace.current())
+                ## Decompressed as the parse stage reads it
+                decompress = TSE_trace.start('decompress', membro=name)
+            stream = io.BufferedReader(TSE_reader(zipped.open(name), decompress))
+            yield ano, stream, decompress, output
+
+    def parse(self, item):
+        ano, stream, decompress, output = item
+        try:
+            with TSE_trace.labels(**output['labels']):
+                for df in self.main.parse_frames(stream, ano, **self.kwargs):
+                    if output.get('failed'):
+                        ## The write stage gave up on this output
+                        return
+                    yield output, df
+        except Exception as error:
+            print('[{}] PROBLEM: {} ({})'.format(get_time_now(), output['save_name'], error))
+            yield output, None
+            return
+        finally:
+            stream.close()
+            decompress.close()
+        yield output, self.end
+
+    def write(self, item):
+        output, df = item
+        if output.get('failed'):
+            return
+        try:
+            if df is None:
+                raise ValueError('parse failed')
+            if 'sink' not in output:
+                output['sink'] = TSE_sink(
+                    self.main,
+                    output['save_full'],
+                    output['save_name'],
+                    labels=output['labels'],
+                    **self.kwargs,
+                )
+            if df is self.end:
+                output['sink'].close(TSE_build.writer(output['save_full'], output['record']))
+            else:
+                output['sink'].write(df)
+        except Exception:
+            ## The rest of its batches and its end are ignored, so that a
+            ## partial file is neither renamed into place nor recorded
+            output['failed'] = True
+            if 'sink' in output:
+                output['sink'].abort()
+            if df is not None:
+                raise
+
+    def worker(self, function, number, remaining, lock):
+        source, target = self.queues[number], self.queues[number + 1]
+        while True:
+            item = source.get()
+            if item is self.done:
+                ## Lets the other workers of the stage see it too
+                source.put(self.done)
+                break
+            try:
+                for output in function(item) or ():
+                    target.put(output)
+            except Exception as error:
+                logging.exception(error)
+                print('[{}] PROBLEM in {}: {}'.format(get_time_now(), function.__name__, error))
+        with lock:
+            remaining[number] -= 1
+            if remaining[number] == 0:
+                target.put(self.done)
+
+    def run(self, jobs):
+        lock = threading.Lock()
+        remaining = [workers for _, workers in self.stages]
+        threads = [
+            threading.Thread(target=self.worker, args=(function, number, remaining, lock), daemon=True)
+            for number, (function, workers) in enumerate(self.stages)
+            for _ in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for job in jobs:
+            self.queues[0].put(job)
+        self.queues[0].put(self.done)
+        for thread in threads:
+            thread.join()
+        self.main.writer(**self.kwargs).wait()
+
+
+class TSE_lease:
+    """
+    Claim of a unit of work by one node, as a lock file in a folder shared
+    by all nodes (such as ~/localdatalake on NFS). The file is created
+    with O_EXCL, so a single node gets it, and it is touched every third
+    of the ttl while the work runs. A lock left untouched for longer than
+    the ttl belongs to a node that crashed, and is taken over; the node
+    that held it, if only slow, then leaves the lock of the new owner
+    alone.
+    """
+
+    folder = os.path.expanduser('~/localdatalake/tse_jobs')
+    ttl = 600
+    keep = 2 * 24 * 3600
+
+    def __init__(self, key, ttl=None):
+        self.key = key
+        self.ttl = ttl or self.ttl
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.lock_name = os.path.join(self.folder, name + '.lock')
+        self.done_name = os.path.join(self.folder, name + '.done')
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.stop = threading.Event()
+
+    def is_done(self):
+        return os.path.exists(self.done_name)
+
+    @classmethod
+    def prune(cls, keep=None):
+        """
+        Removes the done markers older than keep seconds. Those of the
+        downloads are keyed by date, so they are not read after a day.
+        """
+        keep = keep or cls.keep
+        try:
+            names = os.listdir(cls.folder)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(cls.folder, name)
+            try:
+                if name.endswith('.done') and time.time() - os.path.getmtime(path) > keep:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def expired(self, name):
+        try:
+            return time.time() - os.path.getmtime(name) > self.ttl
+        except FileNotFoundError:
+            return False
+
+    def claim(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        for attempt in range(2):
+            try:
+                fd = os.open(self.lock_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt or not self.take_over():
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as flsave:
+                json.dump(dict(key=self.key, owner=self.owner, data=get_time_now()), flsave)
+            threading.Thread(target=self.heartbeat, daemon=True).start()
+            return True
+        return False
+
+    def take_over(self):
+        """
+        Moves an expired lock aside. The rename succeeds for a single node;
+        if the lock was renewed in the meantime, it is put back.
+        """
+        if not self.expired(self.lock_name):
+            return False
+        stale_name = '{}.{}.stale'.format(self.lock_name, uuid.uuid4().hex)
+        try:
+            os.rename(self.lock_name, stale_name)
+        except FileNotFoundError:
+            return True
+        if not self.expired(stale_name):
+            try:
+                os.link(stale_name, self.lock_name)
+            except FileExistsError:
+                pass
+            os.remove(stale_name)
+            return False
+        logging.warning(f'Taking over expired claim: {self.key}')
+        os.remove(stale_name)
+        return True
+
+    def owns(self, name=None):
+        try:
+            with open(name or self.lock_name, 'r') as flread:
+                return json.load(flread).get('owner') == self.owner
+        except (OSError, ValueError):
+            return False
+
+    def heartbeat(self):
+        while not self.stop.wait(self.ttl / 3):
+            if not self.owns():
+                logging.warning(f'Claim taken over by another node: {self.key}')
+                return
+            try:
+                os.utime(self.lock_name)
+            except FileNotFoundError:
+                return
+
+    def release(self, done=False):
+        """
+        Removes the lock, if it is still ours. As in take_over, it is
+        moved aside first and put back if another node holds it.
+        """
+        self.stop.set()
+        if done and self.owns():
+            open(self.done_name, 'w').close()
+        release_name = '{}.{}.release'.format(self.lock_name, uuid.uuid4().hex)
+        try:
+            os.rename(self.lock_name, release_name)
+        except FileNotFoundError:
+            return
+        if not self.owns(release_name):
+            try:
+                os.link(release_name, self.lock_name)
+            except FileExistsError:
+                pass
+            os.remove(release_name)
+            return
+        os.remove(release_name)
+
+
+class TSE_jobs:
+    """
+    Runs a Main subclass on several nodes sharing ~/localdatalake. Each
+    node keeps the (ano, estado, member) units of its shard (by a hash of
+    the output name) and claims each one with a TSE_lease before parsing
+    it, so that nodes never work on the same unit. Archives of a single
+    state belong to the shard of their output and are only downloaded by
+    that node; national archives are downloaded by the first node to
+    claim them, while the others go on with other archives. The units of
+    each archive are parsed as soon as it is downloaded. Units claimed by
+    a node that crashed are retried once the claim expires.
+    """
+
+    poll = 30
+
+    def __init__(self, main, shard=None, lease=None, **kwargs):
+        self.main = main
+        self.shard = shard or (0, 1)
+        self.ttl = lease
+        self.kwargs = kwargs
+
+    @staticmethod
+    def parse_shard(text):
+        numero, total = [int(x) for x in text.split('/')]
+        if not 0 <= numero < total:
+            raise ValueError(f'Invalid shard: {text}')
+        return numero, total
+
+    def mine(self, key):
+        numero, total = self.shard
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % total == numero
+
+    def download(self, ano, estado):
+        """
+        Returns the archive, downloading it first if this node claims it,
+        or None while another node is downloading it.
+        """
+        key = 'download|{}|{}|{}|{}'.format(self.main.__name__, ano, estado, datetime.now().date())
+        lease = TSE_lease(key, ttl=self.ttl)
+        with self.main.labels(ano=ano, estado=estado):
+            if not lease.is_done():
+                if not lease.claim():
+                    return None
+                try:
+                    self.main.class_downloader.download(
+                        ano=ano,
+                        estado=estado,
+                        save=True,
+                        revalidate=self.kwargs.get('revalidate') or self.kwargs.get('incremental'),
+                    )
+                except BaseException:
+                    lease.release()
+                    raise
+                lease.release(done=True)
+            return self.main.class_downloader.download(ano=ano, estado=estado, stream=True)
+
+    def key(self, save_name):
+        return 'parse|{}|{}'.format(self.main.__name__, save_name)
+
+    def archives(self, anos=None, estados=None):
+        """
+        The (ano, estado) of the archives with units of this shard that
+        still need to be parsed.
+        """
+        main = self.main
+        for ano in (anos or main.anos):
+            for estado in main.list_estados(estados, **self.kwargs):
+                if estado is not None and not self.mine(self.key(main.save_name.format(ano=ano, estado=estado))):
+                    continue
+                if main.needs_update(ano=ano, estado=estado, **self.kwargs):
+                    yield ano, estado
+
+    def units(self, ano, estado):
+        """
+        Returns the (key, ano, archive, name, save_name, save_full, record)
+        of the units of this shard in the archive, or None while another
+        node is downloading it.
+        """
+        try:
+            zipped = self.download(ano, estado)
+        except (IOError, requests.RequestException) as error:
+            print('[{}] PROBLEM downloading: {} {} ({})'.format(get_time_now(), ano, estado, error))
+            return []
+        if zipped is None:
+            return None
+        return [
+            (self.key(save_name), ano, zipped.filename, name, save_name, save_full, record)
+            for name, save_name, save_full, record in self.main.list_members(zipped, **self.kwargs)
+            ## Archives of a single state were chosen by shard already
+            if estado is not None or self.mine(self.key(save_name))
+        ]
+
+    def run_unit(self, unit):
+        """
+        Parses the unit if this node can claim it. Returns False if it is
+        claimed by another node.
+        """
+        key, ano, archive, name, save_name, save_full, record = unit
+        lease = TSE_lease(key, ttl=self.ttl)
+        if not lease.claim():
+            return False
+        try:
+            if self.kwargs.get('force') or not self.main.writer(**self.kwargs).exists(save_full) or (
+                    self.kwargs.get('incremental') and not TSE_build.is_current(save_full, record)):
+                self.main.parse_member(archive, name, ano, save_name, save_full, record, **self.kwargs)
+            else:
+                print('[{}] Done elsewhere: {}'.format(get_time_now(), save_name))
+        except (MemoryError, ValueError, pandas.errors.EmptyDataError) as error:
+            print('[{}] PROBLEM: {} ({})'.format(get_time_now(), save_name, error))
+        finally:
+            lease.release()
+        return True
+
+    def run(self, anos=None, estados=None):
+        TSE_lease.prune()
+        archives = collections.deque(self.archives(anos, estados))
+        print('[{}] {} archives in shard {}/{} of {}'.format(get_time_now(), len(archives), *self.shard, self.main.__name__))
+        claimed = []
+        waiting = 0
+        while archives or claimed:
+            if archives and waiting < len(archives):
+                ano, estado = archives.popleft()
+                units = self.units(ano, estado)
+                if units is None:
+                    archives.append((ano, estado))
+                    waiting += 1
+                else:
+                    waiting = 0
+                    claimed += [x for x in units if not self.run_unit(x)]
+                continue
+            ## Waits for the other nodes, taking over the claims that expire
+            time.sleep(self.poll)
+            waiting = 0
+            claimed = [x for x in claimed if not self.run_unit(x)]
+        self.main.writer(**self.kwargs).wait()
 
 
 class Main:
@@ -939,49 +2557,290 @@ class Main:
 
     @classmethod
     def main_loop(cls, anos=None, estados=None, **kwargs):
+        TSE_write.forget()
+        if kwargs.get('shard'):
+            return TSE_jobs(cls, **kwargs).run(anos=anos, estados=estados)
+        if kwargs.get('pipeline'):
+            jobs = [(ano, estado) for ano in (anos or cls.anos) for estado in cls.list_estados(estados, **kwargs)]
+            return TSE_pipeline(cls, queue_size=kwargs.get('queue_size') or 4, **kwargs).run(jobs)
+        if (kwargs.get('download_concurrency') or 1) > 1:
+            cls.main_loop_concurrent(anos=anos, estados=estados, **kwargs)
+        else:
+            for ano in (anos or cls.anos):
+                for estado in cls.list_estados(estados, **kwargs):
+                    cls.main(ano=ano, estado=estado, **kwargs)
+        cls.writer(**kwargs).wait()
+
+    @classmethod
+    def main_loop_concurrent(cls, anos=None, estados=None, **kwargs):
+        """
+        Downloads several files at once, parsing each one on a separate
+        pool as soon as its download finishes.
+        """
+        pending = []
         for ano in (anos or cls.anos):
-            for estado in (estados or cls.estados):
-                cls.main(ano=ano, estado=estado, **kwargs)
+            for estado in cls.list_estados(estados, **kwargs):
+                if cls.needs_update(ano=ano, estado=estado, **kwargs):
+                    pending.append((ano, estado))
+                else:
+                    cls.main(ano=ano, estado=estado, **kwargs)
+
+        parse_kwargs = dict(kwargs, stream=True)
+        with ThreadPoolExecutor(max_workers=kwargs.get('download_concurrency')) as downloads, \
+                ThreadPoolExecutor(max_workers=kwargs.get('workers') or 1) as parsers:
+            futures = {
+                downloads.submit(cls.prefetch, ano=ano, estado=estado, **kwargs): (ano, estado)
+                for ano, estado in pending
+            }
+            parsing = []
+            for future in as_completed(futures):
+                ano, estado = futures[future]
+                try:
+                    future.result()
+                except (IOError, requests.RequestException):
+                    print('[{}] PROBLEM downloading: {} {}'.format(get_time_now(), ano, estado))
+                    continue
+                if not kwargs.get('save_raw'):
+                    parsing.append(parsers.submit(cls.main, ano=ano, estado=estado, **parse_kwargs))
+            for future in parsing:
+                future.result()
+
+    @classmethod
+    def list_estados(cls, estados=None, **kwargs):
+        """
+        The states to download. With ufs, only those are downloaded and,
+        in national archives, only their members are parsed.
+        """
+        ufs = kwargs.get('ufs')
+        return [x for x in (estados or cls.estados) if x is None or not ufs or x in ufs]
+
+    @classmethod
+    def needs_update(cls, ano=None, estado=None, **kwargs):
+        if kwargs.get('incremental'):
+            ## Decided member by member, after checking the source
+            return True
+        if kwargs.get('force'):
+            return True
+        if cls.is_national(estado):
+            ## One output per state in the archive
+            ufs = kwargs.get('ufs')
+            estados = [x for x in cls.archive_estados(ano) or ESTADOS_TODOS if not ufs or x in ufs]
+            return not all(cls.writer(**kwargs).planned(cls.output(ano=ano, estado=x, **kwargs)) for x in estados)
+        return not cls.writer(**kwargs).planned(cls.output(ano=ano, estado=estado, **kwargs))
+
+    @classmethod
+    def is_national(cls, estado=None):
+        """
+        Whether the archive of all states is split into one output per state.
+        """
+        return estado is None and '{estado}' in cls.save_name
+
+    @classmethod
+    def archive_estados(cls, ano):
+        """
+        States found in the national archive of the year when it was last
+        listed, or None if it never was. Kept as a build record.
+        """
+        record = TSE_build.read(os.path.join(cls.folder, cls.save_name.format(ano=ano, estado='UFs')))
+        return record and record.get('estados')
+
+    @classmethod
+    def record_estados(cls, download):
+        estados = collections.defaultdict(set)
+        for name in cls.class_downloader.member_names(download):
+            match = cls.regular_expression.match(os.path.basename(name))
+            if match and 'brasil' not in name.lower():
+                estados[match.group(1)].add(match.group(2))
+        os.makedirs(cls.folder, exist_ok=True)
+        for ano, values in estados.items():
+            TSE_build.write(os.path.join(cls.folder, cls.save_name.format(ano=ano, estado='UFs')), dict(estados=sorted(values)))
+
+    @classmethod
+    def writer(cls, **kwargs):
+        return WRITERS[kwargs.get('formato') or 'csv']
+
+    @classmethod
+    def output(cls, ano=None, estado=None, **kwargs):
+        return cls.writer(**kwargs).path(cls, ano=ano, estado=estado)
+
+    @classmethod
+    def labels(cls, ano=None, estado=None):
+        return TSE_trace.labels(dataset=cls.save_name.split('_')[0], ano=ano, UF=estado)
+
+    @classmethod
+    def prefetch(cls, ano=None, estado=None, **kwargs):
+        with cls.labels(ano=ano, estado=estado):
+            cls.class_downloader.download(
+                ano=ano,
+                estado=estado,
+                save=True,
+                revalidate=kwargs.get('revalidate') or kwargs.get('incremental'),
+            )
 
     @classmethod
     def main(cls, ano=None, estado=None, **kwargs):
-        save_name = cls.save_name.format(ano=ano, estado=estado)
-        save_full = os.path.join(cls.folder, save_name)
-        if kwargs.get('force') or not (os.path.exists(save_full) or os.path.exists(save_full+'.gz')):
-            print('[{}] Downloading {}'.format(get_time_now(), save_name))
-            download = cls.class_downloader.download(ano=ano, estado=estado, save=kwargs.get('save_raw'))
-            print('[{}] Downloaded'.format(get_time_now()))
+        save_name = cls.writer(**kwargs).name(cls, ano=ano, estado='*' if cls.is_national(estado) else estado)
+        if cls.needs_update(ano=ano, estado=estado, **kwargs):
+            revalidate = kwargs.get('revalidate') or kwargs.get('incremental')
+            try:
+                with cls.labels(ano=ano, estado=estado):
+                    download = cls.class_downloader.download(
+                        ano=ano,
+                        estado=estado,
+                        save=kwargs.get('save_raw'),
+                        ## Revalidating needs a local copy, which is kept
+                        ## when streaming to disk
+                        stream=kwargs.get('stream') or revalidate,
+                        revalidate=revalidate,
+                    )
+            except (IOError, requests.RequestException) as error:
+                print('[{}] PROBLEM downloading: {} ({})'.format(get_time_now(), save_name, error))
+                return
             if download:
-                for name in download.namelist():
-                    if (name.endswith('txt') or name.endswith('csv')) and ('brasil' not in name.lower()):
+                members = cls.list_members(download, **kwargs)
+                if (kwargs.get('processes') or 1) > 1:
+                    cls.parse_members_parallel(download, members, ano=ano, **kwargs)
+                else:
+                    for name, save_name, save_full, record in members:
                         try:
-                            basename = os.path.basename(name)
-                            match = cls.regular_expression.match(basename)
-                            if match:
-                                groups = match.groups()
-                            else:
-                                print('[{}] NOT MATCHED: {}'.format(get_time_now(), basename))
-                                continue
-                            save_name = cls.save_name.format(ano=groups[0], estado=groups[1])
-                            save_full = os.path.join(cls.folder, save_name)
-                            if kwargs.get('force') or not (os.path.exists(save_full) or os.path.exists(save_full+'.gz')):
-                                print('[{}] Parsing {}'.format(get_time_now(), save_name))
-                                with download.open(name) as flread:
-                                    df = cls.class_parser.parse(
-                                        flread.read(),
-                                        ano=ano,
-                                        **cls.parser_kwargs,
-                                    )
-                                print('[{}] Parsed {}'.format(get_time_now(), save_name))
-                                df.to_csv(save_full, index=False, header=True, sep=';', float_format='%.0f')
-                                print('[{}] Saved {}'.format(get_time_now(), save_name))
-                        except (MemoryError, pandas.errors.EmptyDataError):
-                            print('[{}] PROBLEM: {}'.format(get_time_now(), save_name))
-                            files = {}
+                            cls.parse_member(download, name, ano, save_name, save_full, record, **kwargs)
+                        except (MemoryError, ValueError, pandas.errors.EmptyDataError) as error:
+                            print('[{}] PROBLEM: {} ({})'.format(get_time_now(), save_name, error))
         else:
             print('[{}] Found: {}'.format(get_time_now(), save_name))
             pass
 
+    @classmethod
+    def list_members(cls, download, **kwargs):
+        """
+        Lists the (name, save_name, save_full, record) of the members of
+        the archive that still need to be parsed. With incremental=True,
+        existing outputs are rebuilt only if their build record changed.
+        """
+        members = []
+        if cls.is_national(cls.estados[0]):
+            cls.record_estados(download)
+        for name in cls.class_downloader.member_names(download, estados=kwargs.get('ufs')):
+            if 'brasil' not in name.lower():
+                basename = os.path.basename(name)
+                match = cls.regular_expression.match(basename)
+                if match:
+                    groups = match.groups()
+                else:
+                    print('[{}] NOT MATCHED: {}'.format(get_time_now(), basename))
+                    continue
+                save_name = cls.save_name.format(ano=groups[0], estado=groups[1])
+                save_full = cls.output(ano=groups[0], estado=groups[1], **kwargs)
+                record = TSE_build.record(cls, download, name, ano=groups[0], **kwargs)
+                if kwargs.get('force') or not cls.writer(**kwargs).exists(save_full):
+                    members.append((name, save_name, save_full, record))
+                elif kwargs.get('incremental') and not TSE_build.is_current(save_full, record):
+                    print('[{}] Changed: {}'.format(get_time_now(), save_name))
+                    members.append((name, save_name, save_full, record))
+                elif kwargs.get('incremental'):
+                    print('[{}] Found: {}'.format(get_time_now(), save_name))
+        return members
+
+    @classmethod
+    def parse_member(cls, source, name, ano, save_name, save_full, record=None, **kwargs):
+        """
+        Parses one member of the archive and saves it. The source is
+        either the content of the member, the ZipFile or the path of
+        the archive.
+        """
+        match = cls.regular_expression.match(os.path.basename(name))
+        with cls.labels(ano=match.group(1), estado=match.group(2)):
+            if isinstance(source, bytes):
+                cls.save(cls.parse_frames(source, ano, **kwargs), save_full, save_name, record, **kwargs)
+            else:
+                zipped = source if isinstance(source, zipfile.ZipFile) else zipfile.ZipFile(source)
+                decompress = TSE_trace.start('decompress', membro=name)
+                try:
+                    with zipped.open(name) as flread:
+                        flread = io.BufferedReader(TSE_reader(flread, decompress))
+                        cls.save(cls.parse_frames(flread, ano, **kwargs), save_full, save_name, record, **kwargs)
+                finally:
+                    decompress.close()
+
+    @classmethod
+    def parse_member_process(cls, *args, **kwargs):
+        """
+        parse_member in a worker process, which waits for the writer, so
+        that nothing is left compressing when the process ends.
+        """
+        cls.parse_member(*args, **kwargs)
+        cls.writer(**kwargs).wait()
+
+    @classmethod
+    def parse_frames(cls, file_object, ano, **kwargs):
+        """
+        Returns the parsed DataFrames: a single one, or one per batch of
+        rows when a chunksize is given.
+        """
+        if kwargs.get('chunksize'):
+            return cls.class_parser.parse_chunks(
+                file_object,
+                ano=ano,
+                chunksize=kwargs.get('chunksize'),
+                **cls.parser_kwargs,
+            )
+        if not isinstance(file_object, bytes):
+            file_object = file_object.read()
+        return [cls.class_parser.parse(file_object, ano=ano, engine=kwargs.get('engine'), **cls.parser_kwargs)]
+
+    @classmethod
+    def save(cls, frames, save_full, save_name=None, record=None, **kwargs):
+        """
+        Writes the frames, and the build record once the output exists.
+        """
+        sink = TSE_sink(cls, save_full, save_name, **kwargs)
+        try:
+            for df in frames:
+                sink.write(df)
+            sink.close(TSE_build.writer(save_full, record))
+        except BaseException:
+            sink.abort()
+            raise
+        finally:
+            sink.span.close()
+
+    @classmethod
+    def parse_members_parallel(cls, download, members, ano=None, **kwargs):
+        """
+        Parses the members of the archive on a pool of processes. Archives
+        on disk are opened by each worker; otherwise the content of each
+        member is sent to the worker.
+        """
+        processes = kwargs.get('processes')
+        on_disk = isinstance(download.filename, str) and os.path.exists(download.filename)
+        with ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=TSE_trace.configure,
+                initargs=(TSE_trace.output, TSE_trace.run)) as pool:
+            running = {}
+            for name, save_name, save_full, record in members:
+                if len(running) >= 2 * processes:
+                    ## Keeps only a few members in memory at once
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    cls.check_parallel(done, running)
+                if on_disk:
+                    source = download.filename
+                else:
+                    with download.open(name) as flread:
+                        source = flread.read()
+                future = pool.submit(cls.parse_member_process, source, name, ano, save_name, save_full, record, **kwargs)
+                running[future] = save_name
+            cls.check_parallel(list(running), running)
+
+    @classmethod
+    def check_parallel(cls, done, running):
+        for future in done:
+            save_name = running.pop(future)
+            try:
+                future.result()
+            except (MemoryError, ValueError, pandas.errors.EmptyDataError, BrokenProcessPool) as error:
+                print('[{}] PROBLEM: {} ({})'.format(get_time_now(), save_name, error))
+
 
 class Main_demografia_zona(Main):
 
@@ -1057,8 +2916,28 @@ if __name__ == '__main__':
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--dados')
     arguments.add_argument('--anos', default=None)
+    arguments.add_argument('--ufs', default=None)
     arguments.add_argument('--force', action='store_true')
+    arguments.add_argument('--incremental', action='store_true')
     arguments.add_argument('--download', action='store_true')
+    arguments.add_argument('--stream', action='store_true')
+    arguments.add_argument('--revalidate', action='store_true')
+    arguments.add_argument('--download-concurrency', type=int, default=1)
+    arguments.add_argument('--workers', type=int, default=1)
+    arguments.add_argument('--processes', type=int, default=1)
+    arguments.add_argument('--pipeline', action='store_true')
+    arguments.add_argument('--queue-size', type=int, default=4)
+    arguments.add_argument('--shard', type=TSE_jobs.parse_shard, default=None)
+    arguments.add_argument('--lease', type=int, default=TSE_lease.ttl)
+    arguments.add_argument('--chunksize', type=int, default=None)
+    arguments.add_argument('--engine', choices=['c', 'python', 'pyarrow'], default=None)
+    arguments.add_argument('--cache', action='store_true')
+    arguments.add_argument('--formato', choices=sorted(WRITERS), default='csv')
+    arguments.add_argument('--warehouse', choices=sorted(tse_warehouse.WAREHOUSES), default=None)
+    arguments.add_argument('--warehouse-modo', choices=['replace', 'append'], default='replace')
+    arguments.add_argument('--per-host', type=int, default=TSE_download_manager.max_per_host)
+    arguments.add_argument('--trace', default=None)
+    arguments.add_argument('--trace-summary', action='store_true')
     parsed = arguments.parse_args()
 
     def parse_int(x):
@@ -1073,8 +2952,42 @@ if __name__ == '__main__':
         anos = None
     force = parsed.force
     save_raw = parsed.download
-
-    kwargs = dict(force=force, save_raw=save_raw)
+    stream = parsed.stream
+    revalidate = parsed.revalidate
+
+    TSE_download_manager.max_per_host = parsed.per_host
+    if parsed.cache:
+        TSE_parse.cache = TSE_cache()
+    if parsed.trace:
+        TSE_trace.configure(output=parsed.trace)
+    elif parsed.trace_summary:
+        ## Collects the spans of the worker processes too
+        TSE_trace.configure(output=os.path.join(tempfile.mkdtemp(), 'trace.jsonl'))
+    else:
+        TSE_trace.configure()
+
+    kwargs = dict(
+        force=force,
+        ufs=parsed.ufs.split(',') if parsed.ufs else None,
+        incremental=parsed.incremental,
+        save_raw=save_raw,
+        stream=stream,
+        revalidate=revalidate,
+        download_concurrency=parsed.download_concurrency,
+        workers=parsed.workers,
+        processes=parsed.processes,
+        pipeline=parsed.pipeline,
+        queue_size=parsed.queue_size,
+        shard=parsed.shard,
+        lease=parsed.lease,
+        chunksize=parsed.chunksize,
+        formato=parsed.formato,
+        engine=parsed.engine,
+        warehouse=parsed.warehouse,
+        warehouse_modo=parsed.warehouse_modo,
+    )
+    if parsed.dados in ['municipios', 'tudo']:
+        TSE_municipios.main_loop(anos=anos, force=force, stream=stream)
     if parsed.dados in ['candidatos', 'tudo']:
         Main_candidatos.main_loop(anos=anos, **kwargs)
     if parsed.dados in ['demografia_zona', 'demografia', 'tudo']:
@@ -1087,3 +3000,5 @@ if __name__ == '__main__':
         Main_votacao_detalhesecao.main_loop(anos=anos, **kwargs)
     if parsed.dados in ['votos', 'votos_zona', 'tudo']:
         Main_votacao_candidato_zona.main_loop(anos=anos, **kwargs)
+    if parsed.trace_summary:
+        print(TSE_trace.summary())
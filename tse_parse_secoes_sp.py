@@ -1,4 +1,5 @@
 import pandas
+import numpy
 import logging
 import os
 import glob
@@ -26,9 +27,13 @@ class File_SecoesSP(FilesRaw):
     )
     source = 'http://www.tre-sp.jus.br/eleitor/titulo-e-local-de-votacao/consulta-por-zona-eleitoral-e-bairro'
 
+    exp_intervalo = re.compile('^Da ([0-9]{1,})[ªºa] à ([0-9]{1,})[ªºa]')
+    exp_secao = re.compile('^([0-9]{1,})[ªºa]')
+    ## The Nome is written as "1a ZONA", unlike the sections
+    exp_nome = re.compile('^([0-9]{1,})a')
+
     @classmethod
     def parse_list_secoes(cls, list_as_string):
-        special = 'ª'
         output = []
         try:
             for s in list_as_string.split(';'):
@@ -40,15 +45,13 @@ class File_SecoesSP(FilesRaw):
     @classmethod
     def parse_string_secao(cls, s):
         ss = s.strip().strip('.')
-        
-        exp = re.compile('Da ([0-9]{1,})ª à ([0-9]{1,})ª')
-        match = exp.match(ss)
+
+        match = cls.exp_intervalo.match(ss)
         if match:
             numbers = [int(x) for x in match.groups()]
             return list(range(numbers[0], numbers[1]+1))
 
-        exp = re.compile('([0-9]{1,})ª')
-        match = exp.match(ss)
+        match = cls.exp_secao.match(ss)
         if match:
             numbers = [int(x) for x in match.groups()]
             return [numbers[0]]
@@ -60,36 +63,203 @@ class File_SecoesSP(FilesRaw):
     @classmethod
     def parse_string_nome(cls, s):
         ss = s.strip().strip('.')
-        exp = re.compile('([0-9]{1,})a')
-        match = exp.match(ss)
+        match = cls.exp_nome.match(ss)
         if match:
             numbers = [int(x) for x in match.groups()]
             return numbers[0]
 
+    @classmethod
+    def parse_intervalos(cls, series):
+        """
+        Same as parse_list_secoes, for a whole column: returns the
+        (linha, Início, Fim) of each range of sections, where linha is
+        the position of the row in the column.
+        """
+        ss = series.reset_index(drop=True)
+        ss = (
+            ss[ss.map(lambda x: isinstance(x, str))]
+            .str.split(';')
+            .explode()
+            .str.strip()
+            .str.strip('.')
+        )
+        intervalo = ss.str.extract(cls.exp_intervalo)
+        secao = ss.str.extract(cls.exp_secao)[0]
+        df = pandas.DataFrame({
+            'linha': ss.index,
+            'Início': intervalo[0].fillna(secao).to_numpy(),
+            'Fim': intervalo[1].fillna(secao).to_numpy(),
+        })
+        invalid = df['Início'].isna().to_numpy()
+        for s in ss[invalid & (ss.str.len() > 0).to_numpy()].unique():
+            logger.warning('Could not parse: {}'.format(s))
+        return df[~invalid].astype(int).reset_index(drop=True)
+
+    @staticmethod
+    def expand(intervalos):
+        """
+        Returns one (linha, Seção) row for each section of the ranges.
+        """
+        sizes = (intervalos['Fim'] - intervalos['Início'] + 1).clip(lower=0).to_numpy()
+        offsets = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        return pandas.DataFrame({
+            'linha': numpy.repeat(intervalos['linha'].to_numpy(), sizes),
+            'Seção': numpy.repeat(intervalos['Início'].to_numpy(), sizes) + offsets,
+        })
+
     @classmethod
     def normalize(cls, df_in):
         """
         Coloca cada seção em uma linha diferente
         """
-        df_v2 = df_in.copy()
-        df_v2['Seções'] = df_v2['Seções'].apply(cls.parse_list_secoes)
-        df_v2['SeçõesEspeciais'] = df_v2['SeçõesEspeciais'].apply(cls.parse_list_secoes)
-        df_v2['SeçõesNao'] = df_v2.apply(
-            lambda row: [x for x in row['Seções'] if x not in row['SeçõesEspeciais']],
-            axis=1,
+        df_v2 = df_in.reset_index(drop=True)
+        secoes = cls.expand(cls.parse_intervalos(df_v2['Seções']))
+        especiais = cls.expand(cls.parse_intervalos(df_v2['SeçõesEspeciais']))
+        index = ['linha', 'Seção']
+        secoes = secoes[~pandas.MultiIndex.from_frame(secoes[index]).isin(
+            pandas.MultiIndex.from_frame(especiais[index])
+        )]
+        secoes['Especial'] = False
+        especiais['Especial'] = True
+
+        return (
+            pandas.concat([secoes, especiais])
+            .sort_values(by=['linha', 'Seção', 'Especial'], kind='stable')
+            .join(cls.locais(df_v2), on='linha')
+            .drop(columns='linha')
+            .reset_index(drop=True)
+        )
+
+    @classmethod
+    def locais(cls, df_in):
+        """
+        Columns of each polling place, with the Zona parsed from the Nome
+        """
+        columns = [x for x in df_in.columns if not x.startswith('Seções')]
+        nomes = df_in['Nome'].astype(str).str.strip().str.strip('.').str.extract(cls.exp_nome)[0]
+        return df_in[columns].assign(Zona=pandas.to_numeric(nomes))
+
+    @classmethod
+    def intervalos(cls, df_in):
+        """
+        Same as normalize, but keeps each range of sections in a single
+        row, from Início to Fim. Special sections may fall inside a range
+        of ordinary ones: lookup gives them precedence.
+        """
+        df_v2 = df_in.reset_index(drop=True)
+        return (
+            pandas.concat([
+                cls.parse_intervalos(df_v2['Seções']).assign(Especial=False),
+                cls.parse_intervalos(df_v2['SeçõesEspeciais']).assign(Especial=True),
+            ])
+            .join(cls.locais(df_v2), on='linha')
+            .drop(columns='linha')
+            .sort_values(by=['Zona', 'Início', 'Especial'], kind='stable')
+            .reset_index(drop=True)
         )
-        df_v2['Zona'] = df_v2['Nome'].apply(cls.parse_string_nome)
-        dataframes = []
-        columns = [x for x in df_v2.columns if not x.startswith('Seções')]
-        for l, row in df_v2.iterrows():
-            df = pandas.DataFrame(
-                sorted([(x, False) for x in row['SeçõesNao']]+[(x, True) for x in row['SeçõesEspeciais']]),
-                columns=['Seção', 'Especial'],
+
+    @staticmethod
+    def search(intervalos, zona, secao, found):
+        """
+        Binary search of each (zona, secao) among the intervals, which must
+        be sorted and not overlap within a Zona. Fills the positions of the
+        matches in found, where it is still -1.
+        """
+        if intervalos.empty:
+            return found
+        chave = lambda z, s: z * 2**20 + s
+        zonas = intervalos['Zona'].to_numpy(dtype=float)
+        position = numpy.searchsorted(
+            chave(zonas, intervalos['Início'].to_numpy(dtype=float)),
+            chave(zona, secao),
+            side='right',
+        ) - 1
+        valid = position.clip(0)
+        match = (
+            (position >= 0)
+            & (zonas[valid] == zona)
+            & (intervalos['Fim'].to_numpy()[valid] >= secao)
+            & (found < 0)
+        )
+        found[match] = intervalos.index.to_numpy()[valid[match]]
+        return found
+
+    @classmethod
+    def lookup(cls, df, intervalos, columns=None):
+        """
+        Interval join: adds to each row of df (such as VotoSecao or
+        PerfilSecao) the columns of the range containing its Zona and
+        Seção. Rows with no range are left with NaN.
+        """
+        if columns is None:
+            columns = [x for x in ['Local', 'Endereço', 'Bairro'] if x in intervalos.columns]
+        intervalos = intervalos.dropna(subset=['Zona']).reset_index(drop=True)
+        zona = pandas.to_numeric(df['Zona'], errors='coerce').to_numpy(dtype=float)
+        secao = pandas.to_numeric(df['Seção'], errors='coerce').to_numpy(dtype=float)
+        found = numpy.full(len(df), -1)
+        ## Ranges without Especial, such as those only in the capital file,
+        ## are taken as ordinary
+        especiais = intervalos['Especial'].fillna(False).astype(bool)
+        for especial in [True, False]:
+            subset = intervalos[especiais == especial].sort_values(by=['Zona', 'Início'])
+            found = cls.search(subset, zona, secao, found)
+        values = intervalos[columns].reindex(found)
+        return df.assign(**{col: values[col].to_numpy() for col in columns})
+
+    @classmethod
+    def merge(cls, df_estado, df_capital):
+        """
+        One row per section of the state file, with the Bairro of the same
+        section in the capital file, plus the sections only found there.
+        """
+        index = ['Zona', 'Seção']
+        columns = ['Nome', 'Local', 'Endereço', 'Município', 'Bairro', 'Especial']
+        return (
+            cls.normalize(df_estado)
+            .merge(
+                cls.normalize(df_capital)[index+['Bairro']],
+                how='outer',
+                on=index,
             )
-            for col in columns:
-                df[col] = row[col]
-            dataframes.append(df)
-        return pandas.concat(dataframes)
+            .sort_values(by=index)
+            [index+columns]
+            .reset_index(drop=True)
+        )
+
+    @staticmethod
+    def collapse(df):
+        """
+        Back to ranges: consecutive sections of a Zona with the same values
+        in the other columns become a single row, from Início to Fim.
+        """
+        df = df.sort_values(by=['Zona', 'Seção'], kind='stable').reset_index(drop=True)
+        columns = [x for x in df.columns if x != 'Seção']
+        previous = df.shift()
+        changed = (df['Seção'] != previous['Seção'] + 1)
+        for col in columns:
+            same = (df[col] == previous[col]) | (df[col].isna() & previous[col].isna())
+            changed |= ~same
+        grupos = changed.cumsum()
+        return (
+            df[changed]
+            .rename(columns={'Seção': 'Início'})
+            .assign(Fim=df['Seção'].groupby(grupos).last().to_numpy())
+            [['Zona', 'Início', 'Fim'] + [x for x in columns if x != 'Zona']]
+            .reset_index(drop=True)
+        )
+
+    @classmethod
+    def expand_intervalos(cls, intervalos):
+        """
+        Back to one row per section, as in normalize
+        """
+        secoes = cls.expand(intervalos.rename_axis('linha').reset_index()[['linha', 'Início', 'Fim']])
+        return (
+            secoes
+            .join(intervalos.drop(columns=['Início', 'Fim']), on='linha')
+            .drop(columns='linha')
+            .reset_index(drop=True)
+        )
 
 
 class File_SecoesSPestado(File_SecoesSP):
@@ -131,23 +301,13 @@ class File_SecoesSPcapital(File_SecoesSP):
 
 def main():
 
-    dfA_in = File_SecoesSPestado().read_file()
-    dfA_out = File_SecoesSP.normalize(dfA_in)
-    dfB_in = File_SecoesSPcapital().read_file()
-    dfB_out = File_SecoesSP.normalize(dfB_in)
-
-    index = ['Zona', 'Seção']
-    columns = ['Nome', 'Local', 'Endereço', 'Município', 'Bairro', 'Especial']
-    df_out = (
-        dfA_out
-        .merge(
-            dfB_out[index+['Bairro']],
-            how='outer',
-            on=index,
-        )
-        .sort_values(by=index)
-        [index+columns]
+    ## The Bairro comes section by section, as a range of the state file
+    ## may span more than one range of the capital file
+    df_secoes = File_SecoesSP.merge(
+        File_SecoesSPestado().read_file(),
+        File_SecoesSPcapital().read_file(),
     )
+    df_out = File_SecoesSP.collapse(df_secoes)
 
     folder = os.path.expanduser(
         os.path.join(
@@ -157,15 +317,18 @@ def main():
             'geografico',
         )
     )
-    filename = 'SecoesEleitorais_SP.csv'
-
-    df_out.to_csv(
-        os.path.join(folder, filename),
-        sep=',',
-        header=True,
-        index=False,
-    )
-    return df_out
+    ## One row per section, as before, and the ranges alongside it
+    for filename, df in [
+        ('SecoesEleitorais_SP.csv', df_secoes),
+        ('SecoesEleitorais_SP_intervalos.csv', df_out),
+    ]:
+        df.to_csv(
+            os.path.join(folder, filename),
+            sep=',',
+            header=True,
+            index=False,
+        )
+    return df_secoes
 
 if __name__ == '__main__':
     main()
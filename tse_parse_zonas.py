@@ -3,11 +3,20 @@ import logging
 import os
 import glob
 import re
+import json
+
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger()
 
 class File_Zonas():
+    """
+    Reads the lists of electoral zones in either of the two formats: the
+    single file of mapaslivres/zonas-eleitorais or the per-UF files
+    exported by the TSE. The format of each file is detected from its
+    header.
+    """
 
     folder = os.path.expanduser(
         os.path.join(
@@ -17,46 +26,168 @@ class File_Zonas():
             'geografico',
         )
     )
-    filename = 'zonas-eleitorais.csv'
-    source = 'https://github.com/mapaslivres/zonas-eleitorais'
+    formatos = {
+        'mapaslivres': dict(
+            filename='zonas-eleitorais.csv',
+            source='https://github.com/mapaslivres/zonas-eleitorais',
+            encoding='utf-8',
+            save_name='ZonasEleitorais.csv',
+        ),
+        'tse': dict(
+            filename=os.path.join('zonas_tse', 'lista_zonas_eleitorais_*.csv'),
+            source='http://www.tse.jus.br/eleitor/cartorios-e-zonas-eleitorais/pesquisa-a-zonas-eleitorais',
+            encoding='latin1',
+            save_name='ZonasEleitorais_BR.csv',
+        ),
+    }
+    columns = [
+        'id',
+        'UF',
+        'Zona',
+        'CEP',
+        'Endereço',
+        'Bairro',
+        'Município_id',
+        'Município_nome',
+    ]
+    workers = 8
 
     @classmethod
-    def find_files(cls):
-        fls = sorted(glob.glob(os.path.join(cls.folder, cls.filename)))
+    def find_files(cls, formato=None):
+        fls = []
+        for key, value in cls.formatos.items():
+            if formato in [None, key]:
+                fls += sorted(glob.glob(os.path.join(cls.folder, value['filename'])))
         return fls
 
     @classmethod
-    def read_file(cls):
-        filename = cls.find_files()[0]
-        df = pandas.read_csv(filename, sep=',', encoding='utf-8', header=0)
-        df = df.rename(columns={
-            'endereco_tse': 'Endereço',
-            'cep': 'CEP',
-            'bairro': 'Bairro',
-            'nome_municipio': 'Município_nome',
-            'uf': 'UF',
-            'municipio_id': 'Município_id',
-        })
-        df['Zona'] = df['id'].apply(lambda x: int(x.split('-')[1]))
-        df['CEP'] = df['CEP'].apply(lambda x: str(x).zfill(8))
-        df = df[[
-            'id',
-            'UF',
-            'Zona',
-            'CEP',
-            'Endereço',
-            'Bairro',
-            'Município_id',
-            'Município_nome',
-        ]]
-        return df.sort_values(by=['UF', 'Zona'])
-
-
-def main():
+    def detect(cls, filename):
+        with open(filename, 'rb') as flread:
+            first_line = flread.readline().decode('latin1')
+        return 'mapaslivres' if 'endereco_tse' in first_line else 'tse'
+
+    @classmethod
+    def read_file(cls, filename=None):
+        """
+        Reads one file, given by its name or by its position in
+        find_files (by default, the first one), sorted by UF and Zona.
+        The files of the TSE have no Município_id.
+        """
+        if filename is None or isinstance(filename, int):
+            filename = cls.find_files()[filename or 0]
+        formato = cls.detect(filename)
+        encoding = cls.formatos[formato]['encoding']
+        if formato == 'mapaslivres':
+            df = pandas.read_csv(filename, sep=',', encoding=encoding, header=0, dtype={'cep': str})
+            df = df.rename(columns={
+                'endereco_tse': 'Endereço',
+                'cep': 'CEP',
+                'bairro': 'Bairro',
+                'nome_municipio': 'Município_nome',
+                'uf': 'UF',
+                'municipio_id': 'Município_id',
+            })
+            df['Zona'] = df['id'].str.split('-').str[1].astype(int)
+        else:
+            df = pandas.read_csv(filename, sep=',', encoding=encoding, header=0, dtype=str)
+            df.columns = [
+                'Zona',
+                'id',
+                'Endereço',
+                'CEP',
+                'Bairro',
+                'Município_nome',
+                'UF',
+            ]
+            df['Zona'] = df['Zona'].astype(int)
+        df['CEP'] = df['CEP'].str.strip().str.zfill(8)
+        return df[[x for x in cls.columns if x in df.columns]].sort_values(by=['UF', 'Zona'])
+
+    @classmethod
+    def read_files(cls, formato=None):
+        """
+        Reads the files of one format (or all of them) on a pool of
+        threads, one file per UF in the format of the TSE.
+        """
+        with ThreadPoolExecutor(max_workers=cls.workers) as pool:
+            dfs = list(pool.map(cls.read_file, cls.find_files(formato)))
+        return pandas.concat(dfs).sort_values(by=['UF', 'Zona']).reset_index(drop=True)
+
+    @classmethod
+    def add_municipio(cls, df, municipios):
+        """
+        Adds the TSE code of each municipality (Município), matched by
+        name and UF in a TSE_municipios index.
+        """
+        df['Município'] = municipios.codigos(df['Município_nome'], df['UF'])
+        return df
+
+    @staticmethod
+    def index_name(save_full):
+        return os.path.splitext(save_full)[0] + '.index.json'
+
+    @classmethod
+    def build_index(cls, df):
+        """
+        Positions of the rows of df by "UF|Zona" and by the first five
+        digits of the CEP.
+        """
+        df = df.reset_index(drop=True)
+        keys = df['UF'].astype(str) + '|' + df['Zona'].astype(str)
+        zonas = dict(zip(keys[~keys.duplicated()], df.index[~keys.duplicated()].tolist()))
+        cep = df.groupby(df['CEP'].str[:5]).groups
+        return dict(
+            zonas=zonas,
+            cep={key: value.tolist() for key, value in cep.items()},
+        )
+
+    @classmethod
+    def save_index(cls, df, save_full):
+        with open(cls.index_name(save_full), 'w') as flsave:
+            json.dump(cls.build_index(df), flsave, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, save_full):
+        """
+        Reads a refined file and its index
+        """
+        df = pandas.read_csv(save_full, sep=',', header=0, dtype={'CEP': str})
+        try:
+            with open(cls.index_name(save_full), 'r') as flread:
+                index = json.load(flread)
+        except (OSError, ValueError):
+            index = cls.build_index(df)
+        return df, index
+
+    @classmethod
+    def join(cls, df, zonas, index, columns=None):
+        """
+        Adds to each row of df (such as VotoZona or PerfilZona) the columns
+        of its zone, found by UF and Zona in the index.
+        """
+        columns = columns or ['CEP', 'Endereço', 'Bairro', 'Município_nome']
+        ## Rows without a valid Zona get no match
+        zona = pandas.to_numeric(df['Zona'], errors='coerce').astype('Int64')
+        keys = df['UF'].astype(str) + '|' + zona.astype(str)
+        position = keys.map(index['zonas']).fillna(-1).astype(int).to_numpy()
+        values = zonas[columns].reindex(position)
+        return df.assign(**{col: values[col].to_numpy() for col in columns})
+
+    @classmethod
+    def por_cep(cls, cep, zonas, index):
+        """
+        Zones whose CEP starts with the same five digits
+        """
+        return zonas.iloc[index['cep'].get(str(cep).zfill(8)[:5], [])]
+
+
+def write_all(formato=None):
+    """
+    Writes the refined file, and its index, of each format found (or of
+    one), returning the DataFrames by format.
+    """
 
     obj = File_Zonas()
-    files = obj.find_files()
-    df_out = obj.read_file()
 
     folder = os.path.expanduser(
         os.path.join(
@@ -66,15 +197,29 @@ def main():
             'geografico',
         )
     )
-    filename = 'ZonasEleitorais.csv'
 
-    df_out.to_csv(
-        os.path.join(folder, filename),
-        sep=',',
-        header=True,
-        index=False,
-    )
-    return df_out
+    outputs = {}
+    for key, value in obj.formatos.items():
+        if formato in [None, key] and obj.find_files(key):
+            df_out = obj.read_files(key)
+            save_full = os.path.join(folder, value['save_name'])
+            df_out.to_csv(
+                save_full,
+                sep=',',
+                header=True,
+                index=False,
+            )
+            obj.save_index(df_out, save_full)
+            outputs[key] = df_out
+    return outputs
+
+
+def main(formato=None):
+    """
+    Same as write_all, returning the DataFrame of the first format
+    written (mapaslivres, if found), or None.
+    """
+    return next(iter(write_all(formato).values()), None)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
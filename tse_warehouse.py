@@ -0,0 +1,245 @@
+import logging
+import os
+import glob
+import re
+import sqlite3
+import argparse
+import datetime
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger()
+
+
+class TSE_warehouse:
+    """
+    Loads the parsed DataFrames into an embedded database, with one table
+    per dataset (VotoSecao, PerfilSecao, Candidatos, ...). Each row keeps
+    the name of the file it came from in the Arquivo column, so that a
+    single (ano, estado) can be replaced without touching the others.
+    The rows of one file are loaded in a single transaction, so a failed
+    load leaves the table as it was.
+    """
+
+    folder = os.path.expanduser(
+        os.path.join(
+            '~',
+            'localdatalake',
+            'tse_refined',
+        )
+    )
+    indices = [
+        ['Arquivo'],
+        ['Ano', 'UF', 'Município', 'Zona', 'Seção'],
+        ['id'],
+        ['Urna_número'],
+    ]
+
+    def __init__(self, filename=None):
+        self.filename = filename or os.path.join(self.folder, self.default_filename)
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.con = self.connect()
+
+    def load(self, frames, table, arquivo, modo='replace'):
+        """
+        Inserts the DataFrames of one file into the table. With
+        modo='replace', the rows previously loaded from the same file are
+        deleted first; with modo='append', they are kept.
+        """
+        self.begin(table, arquivo, modo=modo)
+        try:
+            for df in frames:
+                self.add(df)
+        except BaseException:
+            self.rollback()
+            raise
+        return self.end()
+
+    def begin(self, table, arquivo, modo='replace'):
+        self.table = table
+        self.arquivo = arquivo
+        self.modo = modo
+        self.rows = 0
+        self.start()
+        ## Even if no rows follow, the stale ones are gone
+        if modo == 'replace':
+            self.delete(table, arquivo)
+
+    def add(self, df):
+        self.insert(self.table, self.prepare(df, self.arquivo))
+        self.rows += len(df)
+
+    def end(self):
+        if self.rows:
+            self.create_indices(self.table)
+        self.commit()
+        return self.rows
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
+    @staticmethod
+    def prepare(df, arquivo):
+        df = df.assign(Arquivo=arquivo)
+        for col in df.select_dtypes(include=['category']).columns:
+            df[col] = df[col].astype(object)
+        return df
+
+    def table_exists(self, table):
+        return table in self.tables()
+
+    def delete(self, table, arquivo):
+        if self.table_exists(table):
+            self.con.execute('DELETE FROM "{}" WHERE "Arquivo" = ?'.format(table), [arquivo])
+
+    def columns(self, table):
+        return [x[0] for x in self.con.execute('SELECT * FROM "{}" LIMIT 0'.format(table)).description]
+
+    def create_indices(self, table):
+        columns = self.columns(table)
+        for n, index in enumerate(self.indices):
+            index = [x for x in index if x in columns]
+            if index:
+                self.con.execute(
+                    'CREATE INDEX IF NOT EXISTS "{}_{}" ON "{}" ({})'.format(
+                        table, n, table, ', '.join('"{}"'.format(x) for x in index),
+                    )
+                )
+
+    def load_file(self, path, modo='replace', chunksize=500000):
+        """
+        Loads a CSV written by tse_download_repositorio, such as
+        VotoSecao_2018_SP.csv, into the table VotoSecao.
+        """
+        arquivo = re.sub(r'\.gz$|\.zst$', '', os.path.basename(path))
+        table = arquivo.split('_')[0]
+        ## Imported here, so that importing this module stays cheap
+        import pandas
+        frames = pandas.read_csv(path, sep=';', dtype='str', chunksize=chunksize)
+        return self.load(frames, table, arquivo, modo=modo)
+
+    def close(self):
+        self.con.close()
+
+
+class TSE_warehouse_sqlite(TSE_warehouse):
+
+    default_filename = 'tse.sqlite'
+
+    def connect(self):
+        ## Waits for other processes loading at the same time
+        return sqlite3.connect(self.filename, timeout=600)
+
+    def start(self):
+        ## Explicit, so that creating the table is also undone
+        if not self.con.in_transaction:
+            self.con.execute('BEGIN')
+
+    def tables(self):
+        return [x[0] for x in self.con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+    @staticmethod
+    def sql_type(dtype):
+        if dtype.kind in 'iub':
+            return 'INTEGER'
+        if dtype.kind == 'f':
+            return 'REAL'
+        return 'TEXT'
+
+    @staticmethod
+    def records(df):
+        """
+        The values of df as Python objects that sqlite3 can store, with
+        None for the missing ones and dates as ISO text.
+        """
+        columns = []
+        for col in df.columns:
+            values = df[col]
+            if values.dtype.kind == 'M':
+                values = values.dt.strftime('%Y-%m-%d')
+            values = values.astype(object).where(values.notna(), None)
+            if values.map(lambda x: isinstance(x, datetime.date)).any():
+                values = values.map(lambda x: x.isoformat() if isinstance(x, datetime.date) else x)
+            columns.append(values.map(lambda x: x.item() if hasattr(x, 'item') else x))
+        return zip(*columns)
+
+    def insert(self, table, df):
+        ## Unlike to_sql, executemany does not commit, so the delete and
+        ## the inserts of a file are a single transaction
+        if not self.table_exists(table):
+            self.con.execute('CREATE TABLE "{}" ({})'.format(
+                table, ', '.join('"{}" {}'.format(col, self.sql_type(df[col].dtype)) for col in df.columns),
+            ))
+        self.con.executemany(
+            'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                table,
+                ', '.join('"{}"'.format(col) for col in df.columns),
+                ', '.join('?' for _ in df.columns),
+            ),
+            self.records(df),
+        )
+
+
+class TSE_warehouse_duckdb(TSE_warehouse):
+    """
+    DuckDB allows a single writing process, so it cannot be used with
+    more than one parsing process.
+    """
+
+    default_filename = 'tse.duckdb'
+
+    def connect(self):
+        ## Imported here, as it is only needed by this warehouse
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError('duckdb is needed for the duckdb warehouse')
+        return duckdb.connect(self.filename)
+
+    def tables(self):
+        return [x[0] for x in self.con.execute('SHOW TABLES').fetchall()]
+
+    def start(self):
+        self.con.begin()
+
+    def insert(self, table, df):
+        self.con.register('frame', df)
+        if not self.table_exists(table):
+            self.con.execute('CREATE TABLE "{}" AS SELECT * FROM frame LIMIT 0'.format(table))
+        self.con.execute('INSERT INTO "{}" BY NAME SELECT * FROM frame'.format(table))
+        self.con.unregister('frame')
+
+
+WAREHOUSES = {
+    'sqlite': TSE_warehouse_sqlite,
+    'duckdb': TSE_warehouse_duckdb,
+}
+
+
+def main():
+
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--banco', choices=sorted(WAREHOUSES), default='sqlite')
+    arguments.add_argument('--arquivo', default=None)
+    arguments.add_argument('--dados', default='votos,perfil,candidatos')
+    arguments.add_argument('--modo', choices=['replace', 'append'], default='replace')
+    parsed = arguments.parse_args()
+
+    warehouse = WAREHOUSES[parsed.banco](parsed.arquivo)
+    for dados in parsed.dados.split(','):
+        files = sorted(
+            glob.glob(os.path.join(TSE_warehouse.folder, dados, '*.csv'))
+            + glob.glob(os.path.join(TSE_warehouse.folder, dados, '*.csv.gz'))
+            + glob.glob(os.path.join(TSE_warehouse.folder, dados, '*.csv.zst'))
+        )
+        for path in files:
+            rows = warehouse.load_file(path, modo=parsed.modo)
+            logger.info('Loaded {} rows from {}'.format(rows, path))
+    warehouse.close()
+
+if __name__ == '__main__':
+    main()